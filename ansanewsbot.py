@@ -1,162 +1,176 @@
-from telegram.ext import Updater, CallbackContext, CommandHandler, MessageHandler, Filters
+from telegram.ext import Updater, CallbackContext, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
+from delivery import TelegramSender, OutboxWorker, news_payload
+from articles import link_label
 from rssparser import RssParser
+from catalogue import Catalogue, ANSA_RSS_INDEX
+from webhook import WebhookServer
 from dotenv import load_dotenv
 from database import Database
-from telegram import Update
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.utils.helpers import escape_markdown
+from cache import LruCache
 from lxml import etree
 import telegram.ext
+import argparse
 import asyncio
+import logging
+import metrics
+import threading
 import sqlite3
+import shlex
 import time
 import sys
 import os
 
+HELP_MESSAGE = "/list shows all categories and their relative IDs to be activated with\n" \
+               "/active list all active feeds\n" \
+               "/enable followed by the category IDs or 'all', enable one or more feeds update (separated by a whitespace)\n" \
+               "/disable followed by category IDs or 'all', disable one or more feeds update (separated by a whitespace)\n" \
+               "/digest followed by minutes or 'off', collect the news in a single message every few minutes\n" \
+               "/filter add followed by keywords (-keyword to exclude it, \"quotes\" for more words), only the news " \
+               "with one of the keywords and none of the excluded ones are sent\n" \
+               "/filter remove followed by keywords, /filter list shows them\n" \
+               "/search followed by words (\"quotes\" for more words) and optionally a category ID, " \
+               "finds the archived news containing all of them\n" \
+               "/help shows what each command does"
+
+MAX_FILTERS = 50  # keywords per chat
+SEARCH_PAGE = 5  # news per /search page
+
 
 class Bot:
     _token: str
     updater: Updater
     DB: Database
-    urls: list
-    id_categories: dict
+    catalogue: Catalogue
+    list_message: str
+    sender: TelegramSender
+    deliver: bool
+    searches: LruCache
 
-    def __init__(self, token):
+    def __init__(self, token, send_workers: int = 32, db_name: str = "bot.db", base_url: str = None,
+                 deliver: bool = True, catchup_window: int = 3600, index_url: str = ANSA_RSS_INDEX):
+        """ base_url = Bot API endpoint (default telegram's), used to point the bot to a local stand-in
+            deliver = also drain the outbox in this process, False when 'delivery.py' workers do it
+            catchup_window = seconds of news recovered after a restart (see 'Database')
+            index_url = page listing the feeds the catalogue is refreshed from """
         self._token = token
-        self.updater = Updater(token=self._token, use_context=True)
-        self.DB = Database("bot.db")
-        self.urls = self._fetch_urls()
-        self.id_categories = self._init_cat_id_dict()
-
-    @staticmethod
-    def _init_cat_id_dict() -> dict:
-        """ Initialize dict of keys = category id, value = category name """
-        return {
-            "Abruzzo": 1, "Basilicata": 2, "Calabria": 3, "Campania": 4, "Emilia Romagna": 5,
-            "Friuli Venezia Giulia": 6, "Lazio": 7, "Liguria": 8, "Lombardia": 9, "Marche": 10,
-            "Molise": 11, "Piemonte": 12, "Puglia": 13, "Sardegna": 14, "Sicilia": 15,
-            "Toscana": 16, "Trentino Alto Adige/Suedtirol": 17, "Umbria": 18, "Valle d'Aosta": 19, "Veneto": 20,
-            "Canale Europa": 21, "Europarlamento 2019": 22, "La tua Europa": 23, "AgriUe": 24, "Europa delle Regioni": 25,
-            "Proprietà intellettuale": 26, "Homepage": 27, "Cronaca": 28, "Politica": 29, "Mondo": 30,
-            "Economia": 31, "Calcio": 32, "Sport": 33, "Cinema": 34, "Cultura": 35,
-            "Tecnologia": 36, "Ultima Ora": 37, "English News": 38, "Foto": 39, "Video": 40,
-            "Ambiente&Energia": 41, "Canale Motori": 42, "Canale Terra&Gusto": 43,
-            "Canale Salute&Benessere": 44, "Canale Scienza&Tecnica": 45,
-            "Canale Nuova Europa (IT)": 46, "Canale Nuova Europa (EN)": 47, "ANSA Viaggiart": 48, "Lifestyle": 49
-        }  # cat_id:cat_name
+        # the Bot API connection pool must be as large as the pool of threads sending through it
+        self.updater = Updater(token=self._token, use_context=True, base_url=base_url,
+                               request_kwargs={"con_pool_size": send_workers + 4})
+        self.DB = Database(db_name, catchup_window)
+        self.catalogue = Catalogue(self.DB, os.path.join(os.path.dirname(db_name), "catalogue.json"), index_url)
+        self._render_list(self.catalogue)
+        self.catalogue.add_listener(self._render_list)
+        self.sender = TelegramSender(self.updater.bot, self.DB, send_workers)
+        self.deliver = deliver
+        self.searches = LruCache(4096, 24 * 3600)  # (chat_id, message_id) of a /search answer: (terms, category_id)
 
 # async thread functions from here
 
     async def update_and_publish_rss(self) -> None:
-        """ Initialize instance of RssParser for given database and list of urls(rss)
+        """ Initialize instance of RssParser for given database (which holds the rss urls)
             and fetch news until a match of database pubdate or the last xml item found
-            thus post them into every chat that enabled the news's category """
-        rss_parser = RssParser(self.DB, self.urls)
+            thus queue them in the outbox for every chat that enabled the news's category,
+            the outbox is drained by an in-process OutboxWorker unless 'deliver' is False,
+            the categories are refreshed from the ANSA index in the background """
+        rss_parser = RssParser(self.DB)
+        worker = asyncio.create_task(OutboxWorker(self.DB, self.sender).run()) if self.deliver else None
+        refresher = asyncio.create_task(self.catalogue.run(rss_parser.client))
+        syncer = asyncio.create_task(self._sync_chats())
         try:
             while True:
                 try:
-                    new_feeds = await rss_parser.parse_feed()
-                    if not new_feeds:
+                    self.DB.prune_delivered()
+                    self.DB.prune_photo_file_ids()
+                    self.DB.prune_news_payloads()
+                    self.DB.prune_archive()
+                    published = await rss_parser.parse_feed(self._enqueue_news)
+                    if not published:
                         print(f'No news to be found...')
-                        await asyncio.sleep(600)
+                        await asyncio.sleep(rss_parser.seconds_to_next_poll())
                         continue
-                    tasks = (self._get_channels_by_category_id(cat_id, cat_post)
-                             for cat_id, cat_post in new_feeds.items())
-                    await asyncio.gather(*tasks)
-                    print(f'Updating done and posted! See you in 1 minute <3')
-                except telegram.error.BadRequest as e:
-                    print(f'{e.args} telegram.error.BadRequest occurred, ignoring this route of update')
-                    continue
+                    next_poll = rss_parser.seconds_to_next_poll()
+                    print(f'Updating done and queued! See you in {next_poll} seconds <3')
+                    await asyncio.sleep(next_poll)
                 except etree.XMLSyntaxError as e:
                     print(f'{e} etree.XMLSyntaxError occurred, ignoring this route of update')
                 except etree.Error as e:
                     print(f'{e} etree.Error occurred, ignoring this route of update')
+                except Exception:  # never let a bug in a round stop the publishing for good
+                    logging.exception('Unexpected error in the update round, retrying at the next one')
+                    await asyncio.sleep(rss_parser.poll_scheduler.min_interval)
         except KeyboardInterrupt:
             raise
+        finally:
+            refresher.cancel()
+            syncer.cancel()
+            if worker is not None:
+                worker.cancel()
+            await rss_parser.aclose()
 
-    async def _get_channels_by_category_id(self, cat_id: int, cat_post: list) -> None:
-        """ Get all the channels that have cat_id enabled and return a 'channel_id : post' dict """
-        self.DB.exec("SELECT channel_id FROM channel_categories WHERE category_id = ?",
-                     [cat_id])
-        fetched_cursor = self.DB.cursor.fetchall()
-        channels_post = {x[0]: cat_post for x in fetched_cursor}
-        await self._spread_news(channels_post)
-
-    async def _spread_news(self, channels_post: dict) -> None:
-        """ Async HTTP GET requests to send messages into chats """
-        tasks = (self._separate_news(channel_id, cat_post)
-                 for channel_id, cat_post in channels_post.items())
-        await asyncio.gather(*tasks)
-
-    async def _separate_news(self, channel_id: int, cat_post: list):
-        """ Separate the cat_post string into each news link
-            so that the messages are sent every 3 seconds
-            (telegram bots must send 20 messages max in 1 minute!) """
-        category_name = cat_post[0]
-        catid = self.id_categories[category_name]
-        news_list = cat_post[1:]
-        news_list = list(reversed(news_list))  # reverse list so posts get picked from the least recent
-        for title_descr_img_link in news_list:
-            await self._send_message(channel_id, title_descr_img_link, catid)
-            await asyncio.sleep(3)
-
-    async def _send_message(self, channel_id: int, title_descr_img_link: tuple, catid: int) -> None:
-        """ Separating 'send_message' so that it can be called by '_spread_news'
-            as many async tasks in the same time and wait the last one
-            (4096 is the max length of a telegram message) """
-        countdown: int = 2048
-        title, descr, img, link = title_descr_img_link
-        while countdown:
+    async def run_webhook(self, webhook_url: str, listen: str = "127.0.0.1", port: int = 8443,
+                          url_path: str = "/telegram", secret_token: str = None) -> None:
+        """ Receive the updates from telegram through 'WebhookServer' on the loop of the publisher
+            instead of polling getUpdates, webhook_url = public https url forwarded to listen:port/url_path """
+        threading.Thread(target=self.updater.dispatcher.start, name="dispatcher", daemon=True).start()
+        server = WebhookServer(self.updater.bot, self.updater.dispatcher, url_path, secret_token)
+        await server.start(listen, port)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, server.set_webhook, webhook_url)
+            await self.update_and_publish_rss()
+        finally:
+            await server.close()
+
+    def _enqueue_news(self, new_feeds: dict) -> None:
+        """ Write the news of every category into the outbox of every chat that enabled it
+            and whose keyword filters let it through, least recent first;
+            a news carried by several categories is queued once per chat and scanned once for keywords """
+        payloads, targets, found = {}, [], {}
+        for cat_id, cat_post in new_feeds.items():
+            news_list = list(reversed(cat_post[1:]))  # cat_post[0] is the category name
+            channels = self.DB.subscriptions.channels(cat_id)
+            for news in news_list:
+                if news.news_hash not in payloads:
+                    payloads[news.news_hash] = news_payload(news)
+                    found[news.news_hash] = self.DB.filters.find(f'{news.title} {news.descr}')
+                allowed = self.DB.filters.allowed_by(channels, found[news.news_hash])
+                targets.extend((channel_id, news.news_hash, 0) for channel_id in allowed)
+        self.DB.enqueue_news(list(payloads.items()), targets)
+
+    async def _sync_chats(self, interval: float = 60) -> None:
+        """ Every 'interval' seconds write the chat renames seen by 'add_chat_group' and forget the chats
+            the 'delivery.py' workers removed (they blocked the bot) """
+        while True:
+            await asyncio.sleep(interval)
             try:
-                if self.DB.check_last_news(channel_id, title, catid):
-                    break
-                self.updater.bot.send_photo(chat_id=channel_id, photo=img,
-                                            caption=f'{title}{descr[:-6]}\n[Read more]({link})',
-                                            parse_mode='markdown')
-                break
-            except telegram.error.Unauthorized:
-                await self._remove_chat(channel_id)
-                break
-            except telegram.error.TimedOut as e:
-                print(f'{e} (NOT RAISED) occurred trying to send photo update, retrying to send the news...\n'
-                      f' countdown {countdown}')
-                countdown >>= 1
-                await asyncio.sleep(3)
-            except telegram.error.BadRequest as e:
-                print(f'{e.args}: printing self.updater.bot.send_photo args:\n'
-                      f'channel id: {channel_id}\n'
-                      f'image: {img}\n'
-                      f'description: {descr}')
-                raise
-            except telegram.error.RetryAfter as e:
-                print(f'{e.args} occurred trying to send photo update, not sending photo, nor updating epoch')
-                raise
-
-    async def _remove_chat(self, chat_id: int) -> None:
-        self.DB.exec("DELETE FROM channels WHERE channel_id = ?", [chat_id])
-        self.DB.commit()
-
-    def _fetch_urls(self) -> list:
-        self.DB.exec("SELECT feed FROM categories")
-        return [x[0] for x in self.DB.cursor.fetchall()]
+                self.DB.flush_chat_names()
+                self.DB.forget_removed_chats()
+            except Exception:  # the next sync catches up, the renames are kept (see 'flush_chat_names')
+                logging.exception(f'Unexpected error syncing the chats with the database, retrying in {interval}s')
 
 # functions for the bot commands from now on
 
+    def _render_list(self, catalogue: Catalogue) -> None:
+        """ Prepare the '/list' answer, again at every change of the catalogue """
+        lista = '\n'.join([f'{catid}){name}' for catid, name in sorted(catalogue.names.items())])
+        self.list_message = f'To enable feeds, use /enable + [category_id]\n{lista}'
+
     def list_categories(self, update: Update, context: CallbackContext) -> None:
-        """ Use a provided HtmlParser instance to return a dict of categories and rss URLs"""
-        self.DB.exec("SELECT category_id, name FROM categories")
-        catid_catname = self.DB.cursor.fetchall()
-        lista = '\n'.join([f'{x[0]}){x[1]}' for x in catid_catname])
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=f'To enable feeds, use /enable + [category_id]\n'
-                                      f'{lista}')
+        """ Send the ids and names of the categories currently offered by the catalogue """
+        context.bot.send_message(chat_id=update.effective_chat.id, text=self.list_message)
 
     def active_categories(self, update: Update, context: CallbackContext) -> None:
-        active = self.DB.cat_list(update.effective_chat.id)
-        active = "\n".join(active)
+        """ Served from the subscription index, no query """
+        names = self.catalogue.names
+        active = sorted(cat_id for cat_id in self.DB.subscriptions.categories(update.effective_chat.id) if cat_id in names)
+        active = "\n".join(f"{cat_id}) {names[cat_id]}" for cat_id in active)
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text=f'Feed attivi:\n{active}')
 
     def add_command(self, cmd: str, handler):
-        self.updater.dispatcher.add_handler(CommandHandler(cmd, handler))
+        """ Commands run in the dispatcher thread pool, a slow answer never holds the updates queue """
+        self.updater.dispatcher.add_handler(CommandHandler(cmd, handler, run_async=True))
 
     def enable(self, update: Update, context: CallbackContext) -> None:
         self.add_chat_group(update)
@@ -184,12 +198,128 @@ class Bot:
         deleted = " ".join(deleted)
         context.bot.send_message(chat_id=update.effective_chat.id, text=f"You are not gonna receive news from {deleted}")
 
+    def digest(self, update: Update, context: CallbackContext) -> None:
+        """ /digest N collects the chat news in a single message every N minutes, /digest off sends them
+            one by one again, /digest alone shows the current setting """
+        self.add_chat_group(update)
+        chat_id = update.effective_chat.id
+        if not context.args:
+            interval = self.DB.get_digest(chat_id)
+            text = f'Digest every {interval // 60} minutes' if interval else 'Digest disabled, every news is sent on its own'
+            context.bot.send_message(chat_id=chat_id, text=text)
+            return
+        arg = context.args[0].lower()
+        if arg in ('off', '0'):
+            self.DB.set_digest(chat_id, 0)
+            context.bot.send_message(chat_id=chat_id, text='Digest disabled, every news is sent on its own')
+            return
+        if not arg.isdigit() or not 1 <= int(arg) <= 24 * 60:
+            context.bot.send_message(chat_id=chat_id, text='Use /digest followed by the minutes (1-1440) or off')
+            return
+        self.DB.set_digest(chat_id, int(arg) * 60)
+        context.bot.send_message(chat_id=chat_id, text=f'You are gonna receive a digest of the news every {arg} minutes')
+
+    def filter(self, update: Update, context: CallbackContext) -> None:
+        """ /filter add keyword -keyword "more words" | /filter remove keyword | /filter list,
+            a '-' in front of a keyword drops the news containing it """
+        self.add_chat_group(update)
+        chat_id = update.effective_chat.id
+        action, *args = context.args or ['list']
+        try:
+            keywords = shlex.split(' '.join(args))
+        except ValueError:  # unbalanced quotes
+            keywords = args
+        if action == 'add' and keywords:
+            if len(self.DB.filters.filters(chat_id)) + len(keywords) > MAX_FILTERS:
+                context.bot.send_message(chat_id=chat_id, text=f'At most {MAX_FILTERS} keywords per chat!')
+                return
+            filters = [(k[1:], True) if k.startswith('-') else (k, False) for k in keywords]
+            added = self.DB.add_filters(chat_id, [(k, exclude) for k, exclude in filters if len(k.strip()) >= 2])
+            if not added:
+                context.bot.send_message(chat_id=chat_id, text='Keywords must be at least 2 characters long!')
+                return
+            added = ", ".join(f'-{k}' if exclude else k for k, exclude in added)
+            context.bot.send_message(chat_id=chat_id, text=f'Filters added: {added}')
+        elif action == 'remove' and keywords:
+            removed = self.DB.remove_filters(chat_id, [k.lstrip('-') for k in keywords])
+            if not removed:
+                context.bot.send_message(chat_id=chat_id, text='Provided keyword is not a filter of this chat!')
+                return
+            context.bot.send_message(chat_id=chat_id, text=f'Filters removed: {", ".join(removed)}')
+        elif action == 'list':
+            filters = sorted(self.DB.filters.filters(chat_id), key=lambda f: (f[1], f[0]))
+            if not filters:
+                context.bot.send_message(chat_id=chat_id, text='No filters, you receive every news of your feeds')
+                return
+            lista = '\n'.join(f'-{k}' if exclude else k for k, exclude in filters)
+            context.bot.send_message(chat_id=chat_id, text=f'Filtri attivi:\n{lista}')
+        else:
+            context.bot.send_message(chat_id=chat_id, text='Use /filter add|remove followed by keywords, or /filter list')
+
+    def search(self, update: Update, context: CallbackContext) -> None:
+        """ /search words "more words" [category ID] answers the archived news containing every word,
+            best match first, SEARCH_PAGE at a time with buttons to the next and previous pages """
+        self.add_chat_group(update)
+        chat_id = update.effective_chat.id
+        try:
+            terms = shlex.split(' '.join(context.args))
+        except ValueError:  # unbalanced quotes
+            terms = list(context.args)
+        terms = [term for term in terms if term.strip()]
+        category_id = None
+        if len(terms) > 1 and terms[-1].isdigit() and int(terms[-1]) in self.catalogue.names:
+            category_id = int(terms.pop())
+        if not terms:
+            context.bot.send_message(chat_id=chat_id, text='Use /search followed by words and optionally a category ID')
+            return
+        text, markup = self._search_page(terms, category_id, 0)
+        message = context.bot.send_message(chat_id=chat_id, text=text, reply_markup=markup, parse_mode='markdown',
+                                           disable_web_page_preview=True)
+        if markup is not None:
+            self.searches.put((chat_id, message.message_id), (terms, category_id))
+
+    def search_page(self, update: Update, context: CallbackContext) -> None:
+        """ Buttons of a /search answer, 'search:N' replaces the answer with its page N """
+        query = update.callback_query
+        search = self.searches.get((query.message.chat_id, query.message.message_id))
+        if search is None:
+            query.answer(text='Search expired, use /search again')
+            return
+        query.answer()
+        text, markup = self._search_page(*search, int(query.data.split(':')[1]))
+        query.edit_message_text(text=text, reply_markup=markup, parse_mode='markdown', disable_web_page_preview=True)
+
+    def _search_page(self, terms: list, category_id: int, page: int) -> tuple:
+        """ Return the markdown text of the page and its buttons (None when there is a single page) """
+        # one more news than shown tells whether a next page exists
+        found = self.DB.search_archive(terms, category_id, SEARCH_PAGE + 1, page * SEARCH_PAGE)
+        searched = ' '.join(terms)
+        if category_id is not None:
+            searched += f' in {self.catalogue.names.get(category_id, category_id)}'
+        if not found:
+            return escape_markdown(f'No news found for {searched}'), None
+        lines = [f'*{escape_markdown(f"Results for {searched}, page {page + 1}")}*']
+        for title, descr, link, published_at in found[:SEARCH_PAGE]:
+            day = time.strftime("%d/%m/%Y", time.localtime(published_at))
+            lines.append(f'• [{link_label(title, descr, link)}]({link}) {escape_markdown(day)}')
+        buttons = []
+        if page:
+            buttons.append(InlineKeyboardButton('◀ Previous', callback_data=f'search:{page - 1}'))
+        if len(found) > SEARCH_PAGE:
+            buttons.append(InlineKeyboardButton('Next ▶', callback_data=f'search:{page + 1}'))
+        return '\n\n'.join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
     def add_msg_handler(self, filters: telegram.ext.filters.BaseFilter, handler):
         """ Add messages handler, filters are built bitwise with 'Filters' module """
         self.updater.dispatcher.add_handler(MessageHandler(filters, handler))
 
+    def add_callback_handler(self, pattern: str, handler):
+        """ Add a handler of the inline keyboard buttons whose data matches the pattern """
+        self.updater.dispatcher.add_handler(CallbackQueryHandler(handler, pattern=pattern, run_async=True))
+
     def add_chat_group(self, update: Update):
-        """ Check chat group, if needed, add new chat group in database or change the name"""
+        """ Check chat group, if needed, add new chat group in database or change the name
+            (a dict lookup for the chats already known, renames are written in batches) """
         chat_id = update.effective_chat.id
         chat_name = f'{update.effective_chat.title or update.effective_chat.username}'
         self.DB.channel_update_or_insert(chat_id, chat_name)
@@ -201,36 +331,52 @@ class Bot:
         return self.updater.idle()
 
     def stop(self):
+        self.sender.close()
         self.DB.close()
+        if self.updater.dispatcher.running and not self.updater.running:  # started by 'run_webhook'
+            self.updater.dispatcher.stop()
         self.updater.stop()
 
     @staticmethod
     def help(update: Update, context: CallbackContext):
-        help_message = f"/list shows all categories and their relative IDs to be activated with\n" \
-                       f"/active list all active feeds\n" \
-                       f"/enable followed by the category IDs or 'all', enable one or more feeds update (separated by a whitespace)\n" \
-                       f"/disable followed by category IDs or 'all', disable one or more feeds update (separated by a whitespace)\n" \
-                       f"/help shows what each command does"
-        context.bot.send_message(chat_id=update.effective_chat.id, text=help_message)
+        context.bot.send_message(chat_id=update.effective_chat.id, text=HELP_MESSAGE)
 
 
-def main(bot: Bot) -> None:
+def main(bot: Bot, webhook_url: str = None) -> None:
+    """ webhook_url = receive the updates through a webhook (see 'Bot.run_webhook') instead of polling """
     bot.add_msg_handler(Filters.text & (~Filters.command), bot.add_chat_group)
     bot.add_command("list", bot.list_categories)
     bot.add_command("active", bot.active_categories)
     bot.add_command('enable', bot.enable)
     bot.add_command('disable', bot.disable)
+    bot.add_command('digest', bot.digest)
+    bot.add_command('filter', bot.filter)
+    bot.add_command('search', bot.search)
+    bot.add_callback_handler(r'^search:\d+$', bot.search_page)
     bot.add_command('help', Bot.help)
+    if webhook_url:
+        asyncio.run(bot.run_webhook(webhook_url, os.getenv("WEBHOOK_LISTEN", "127.0.0.1"),
+                                    int(os.getenv("WEBHOOK_PORT", 8443)), os.getenv("WEBHOOK_PATH", "/telegram"),
+                                    os.getenv("WEBHOOK_SECRET")))
+        return
     bot.start_polling()
     asyncio.run(bot.update_and_publish_rss())
 
 
 if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="ANSA news telegram bot")
+    arg_parser.add_argument("--no-deliver", action="store_true",
+                            help="only queue the news, 'python delivery.py' workers send them")
+    args = arg_parser.parse_args()
     load_dotenv()
+    if int(os.getenv("METRICS_PORT", 9108)):
+        metrics.start_http_server(int(os.getenv("METRICS_PORT", 9108)))
+    if int(os.getenv("METRICS_LOG_INTERVAL", 0)):
+        metrics.start_log_dump(int(os.getenv("METRICS_LOG_INTERVAL")))
     TOKEN = os.getenv("TOKEN")
-    bot = Bot(TOKEN)
+    bot = Bot(TOKEN, deliver=not args.no_deliver, catchup_window=int(os.getenv("CATCHUP_WINDOW", 3600)))
     try:
-        main(bot)
+        main(bot, os.getenv("WEBHOOK_URL"))
     except KeyboardInterrupt:
         try:
             bot.stop()
@@ -0,0 +1,80 @@
+from telegram.utils.helpers import escape_markdown
+from typing import NamedTuple
+from urllib import parse
+import hashlib
+
+
+def canonical_link(link: str) -> str:
+    """ Normalize an article url so that the same ANSA article carried by different feeds
+        (tracking query strings, fragments, http/https, host case) maps to a single key """
+    url = parse.urlsplit(link.strip())
+    scheme = "https" if url.scheme in ("http", "https") else url.scheme
+    path = url.path or "/"
+    return parse.urlunsplit((scheme, url.netloc.lower(), path, "", ""))
+
+
+def link_hash(link: str) -> str:
+    """ Short stable identity of an article, used as key of the delivered news """
+    return hashlib.sha1(canonical_link(link).encode()).hexdigest()
+
+
+CAPTION_LIMIT = 1024  # telegram limit of a photo caption
+TEXT_LIMIT = 4096  # telegram limit of a text message
+
+
+class NewsMessage(NamedTuple):
+    """ A news rendered once by the parser and shared by reference with every recipient chat """
+    title: str
+    descr: str
+    img: str
+    link: str
+    news_hash: str  # see 'link_hash'
+    caption: str  # markdown caption of the photo, within CAPTION_LIMIT
+    text: str  # markdown text-only form, sent when the photo is refused
+
+
+def render_news(title: str, descr: str, img: str, link: str) -> NewsMessage:
+    """ Build the markdown message of a scraped article: escaped title and description
+        (without the trailing '(ANSA)' signature) followed by the 'Read more' link,
+        the body is cut with an ellipsis when the caption would exceed CAPTION_LIMIT.
+        A link too long for a caption is left to the text form only """
+    body, footer = f'{title}{descr[:-6]}', f'\n[Read more]({link})'
+    text = escape_markdown(body) + footer
+    if len(footer) + len('…') > CAPTION_LIMIT:
+        footer = ''
+    caption = escape_markdown(body) + footer
+    if len(caption) > CAPTION_LIMIT:
+        # keep the longest start of the body whose escaped form fits with the ellipsis and the footer
+        room, cut = CAPTION_LIMIT - len(footer) - len('…'), 0
+        for cut, char in enumerate(body):
+            room -= len(escape_markdown(char))
+            if room < 0:
+                break
+        caption = escape_markdown(f'{body[:cut].rstrip()}…') + footer
+    return NewsMessage(title, descr, img, link, link_hash(link), caption, text)
+
+
+def link_label(title: str, descr: str, link: str, limit: int = 120) -> str:
+    """ Escaped text of a markdown link to an article: its title, the start of its description
+        when it has none (no EdTitle on the page), the link itself as a last resort """
+    label = ' '.join(title.split()) or ' '.join(descr.split()) or link
+    if len(label) > limit:
+        label = f'{label[:limit].rstrip()}…'
+    return escape_markdown(label.replace("]", ")"))
+
+
+def render_digest(news_list: list) -> list:
+    """ Collapse many news into as few text messages as TEXT_LIMIT allows, a linked title per news.
+        Return a list of tuples '(markdown text, news in the text)' """
+    digests, lines, included, size = [], [], [], 0
+    for news in news_list:
+        line = f'• [{link_label(news.title, news.descr[:-6], news.link)}]({news.link})'
+        if lines and size + len(line) + 2 > TEXT_LIMIT:
+            digests.append(('\n\n'.join(lines), included))
+            lines, included, size = [], [], 0
+        lines.append(line)
+        included.append(news)
+        size += len(line) + 2
+    if lines:
+        digests.append(('\n\n'.join(lines), included))
+    return digests
@@ -0,0 +1,279 @@
+""" Offline throughput benchmark of the whole news pipeline.
+
+    A local http server stands in for ANSA (synthetic rss feeds and article pages) and for the
+    telegram Bot API (enforcing the bot rate limits with 429 answers), a generated database holds
+    the chats and their subscriptions, then
+      1) RssParser.parse_feed is timed alone (items/s)
+      2) Bot.update_and_publish_rss runs until every subscribed chat got every article
+    and items/s, messages/s, p50/p99 feed-to-delivery latency and peak RSS memory are reported.
+
+    usage: python benchmarks/bench_pipeline.py --categories 10 --items 5 --chats 50 --subs 2
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import deque, defaultdict
+from email.utils import formatdate
+from urllib import parse
+import threading
+import argparse
+import resource
+import tempfile
+import sqlite3
+import asyncio
+import random
+import json
+import time
+import sys
+import os
+import re
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ansanewsbot import Bot  # noqa: E402
+from rssparser import RssParser  # noqa: E402
+from database import Database  # noqa: E402
+
+TOKEN = "123456:benchmark"
+ARTICLE_RE = re.compile(r'/article/(\d+)')
+
+
+class FakeAnsa:
+    """ Synthetic feeds: every category carries 'items' articles, a fraction 'overlap' of them
+        taken from a pool shared by all categories (like Homepage/Ultima Ora/Cronaca do) """
+    __slots__ = ["feeds", "latency", "published_at"]
+
+    def __init__(self, categories: int, items: int, overlap: float, latency: float, seed: int = 0):
+        rnd = random.Random(seed)
+        shared = list(range(items))
+        next_id = items
+        self.feeds = []
+        for _ in range(categories):
+            articles = set(rnd.sample(shared, int(items * overlap)))
+            while len(articles) < items:
+                articles.add(next_id)
+                next_id += 1
+            self.feeds.append(sorted(articles, reverse=True))
+        self.latency = latency
+        self.published_at = time.time()
+
+    def rss(self, cat: int, host: str) -> bytes:
+        items = ''.join(f"<item><title>Article {art}</title><link>http://{host}/article/{art}</link>"
+                        f"<pubDate>{formatdate(self.published_at - pos, localtime=True)}</pubDate></item>"
+                        for pos, art in enumerate(self.feeds[cat]))
+        return f"<?xml version='1.0' encoding='UTF-8'?><rss><channel>{items}</channel></rss>".encode()
+
+    def index(self) -> bytes:
+        """ The rss index page in the ANSA layout, so the catalogue refresh keeps the generated categories """
+        entries = ''.join(f"<dd><ul><li><a href='#'><span>rss</span>Category {cat}</a></li>"
+                          f"<li><a class='b-rss' href='feed/{cat}'>rss</a></li></ul></dd>"
+                          for cat in range(len(self.feeds)))
+        return f"<html><body><dl>{entries}</dl></body></html>".encode()
+
+    def article(self, art: int, host: str) -> bytes:
+        time.sleep(self.latency)
+        return (f"<html><head><meta name='EdTitle' content='Article {art}'>"
+                f"<meta name='description' content='Synthetic description of article {art}_ANSA_'>"
+                f"<meta property='og:image' content='http://{host}/img/{art}.jpg'>"
+                f"</head><body>{'<p>lorem ipsum</p>' * 2000}</body></html>").encode()
+
+
+class FakeTelegram:
+    """ Bot API stand-in accepting every 'send*' method, answering 429 with retry_after
+        whenever the global or a per chat rate limit would be exceeded """
+    __slots__ = ["global_rate", "private_rate", "group_rate", "lock", "sent", "per_chat", "deliveries",
+                 "rejected", "messages"]
+
+    def __init__(self, global_rate: float, private_rate: float, group_rate: float):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.lock = threading.Lock()
+        self.sent = deque()  # send times in the last second
+        self.per_chat = defaultdict(deque)  # chat_id: send times in the last minute
+        self.deliveries = {}  # (chat_id, article): first delivery time
+        self.rejected = 0
+        self.messages = 0
+
+    def retry_after(self, chat_id: int, now: float) -> int:
+        while self.sent and now - self.sent[0] > 1:
+            self.sent.popleft()
+        if len(self.sent) >= self.global_rate:
+            return 1
+        chat = self.per_chat[chat_id]
+        while chat and now - chat[0] > 60:
+            chat.popleft()
+        if chat_id < 0:
+            if len(chat) >= self.group_rate * 60:
+                return int(61 - (now - chat[0]))
+        elif chat and now - chat[-1] < 1 / self.private_rate:
+            return 1
+        return 0
+
+    def send(self, chat_id: int, text: str) -> tuple:
+        now = time.time()
+        with self.lock:
+            retry_after = self.retry_after(chat_id, now)
+            if retry_after:
+                self.rejected += 1
+                return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {retry_after}",
+                             "parameters": {"retry_after": retry_after}}
+            self.sent.append(now)
+            self.per_chat[chat_id].append(now)
+            self.messages += 1
+            for art in ARTICLE_RE.findall(text):
+                self.deliveries.setdefault((chat_id, int(art)), now)
+        message = {"message_id": self.messages, "date": int(now), "chat": {"id": chat_id, "type": "private"},
+                   "photo": [{"file_id": f"file{self.messages}", "file_unique_id": f"u{self.messages}",
+                              "width": 700, "height": 366}]}
+        return 200, {"ok": True, "result": message}
+
+
+def start_server(ansa: FakeAnsa, tg: FakeTelegram) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status: int, body: bytes, content_type: str = "text/xml") -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            host = self.headers["Host"]
+            if self.path.startswith("/feed/"):
+                self.reply(200, ansa.rss(int(self.path.rsplit("/", 1)[1]), host))
+            elif self.path == "/index":
+                self.reply(200, ansa.index(), "text/html")
+            elif self.path.startswith("/article/"):
+                self.reply(200, ansa.article(int(self.path.rsplit("/", 1)[1]), host), "text/html")
+            else:
+                self.reply(404, b"")
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                payload = json.loads(body or b"{}")
+            else:
+                payload = {k: v[0] for k, v in parse.parse_qs(body.decode(errors="replace")).items()}
+            text = f"{payload.get('caption', '')} {payload.get('text', '')} {json.dumps(payload.get('media', ''))}"
+            status, answer = tg.send(int(payload.get("chat_id", 0)), text)
+            self.reply(status, json.dumps(answer).encode(), "application/json")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def generate_db(path: str, host: str, args) -> dict:
+    """ Create the bot database with the local feeds, 'chats' chats subscribed to 'subs' random categories
+        each, return the set of categories of every chat """
+    rnd = random.Random(args.seed)
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE categories (category_id INTEGER PRIMARY KEY AUTOINCREMENT DEFAULT 0, name TEXT, "
+               "feed TEXT, epoch INTEGER DEFAULT 0)")
+    db.execute("CREATE TABLE channels (channel_id INTEGER PRIMARY KEY NOT NULL, channel_name TEXT)")
+    db.execute("CREATE TABLE channel_categories (channel_id INTEGER, category_id INTEGER, last_news TEXT, "
+               "UNIQUE(channel_id, category_id))")
+    db.executemany("INSERT INTO categories (name, feed) VALUES (?, ?)",
+                   [(f"Category {i}", f"http://{host}/feed/{i}") for i in range(args.categories)])
+    subscriptions = {}
+    for i in range(args.chats):
+        chat_id = -(1000 + i) if rnd.random() < args.group_ratio else 1000 + i
+        subscriptions[chat_id] = set(rnd.sample(range(1, args.categories + 1), min(args.subs, args.categories)))
+        db.execute("INSERT INTO channels VALUES (?, ?)", [chat_id, f"chat {i}"])
+        db.executemany("INSERT INTO channel_categories (channel_id, category_id) VALUES (?, ?)",
+                       [(chat_id, cat) for cat in subscriptions[chat_id]])
+    db.commit()
+    db.close()
+    return subscriptions
+
+
+def reset_feeds(db: Database, epoch: int) -> None:
+    """ Make every feed due and every article unseen again """
+    db.exec("UPDATE categories SET epoch = ?, etag = NULL, last_modified = NULL, next_poll = 0", [epoch])
+    db.commit()
+
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def bench_parser(db: Database, epoch: int, items_total: int) -> None:
+    reset_feeds(db, epoch)
+    rss_parser = RssParser(db)
+    start = time.perf_counter()
+    parsed = await rss_parser.parse_feed()
+    elapsed = time.perf_counter() - start
+    await rss_parser.aclose()
+    print(f"parse_feed: {parsed}/{items_total} items in {elapsed:.2f}s -> {parsed / elapsed:.1f} items/s")
+
+
+async def bench_publisher(bot: Bot, ansa: FakeAnsa, tg: FakeTelegram, expected: int, epoch: int,
+                          timeout: float) -> None:
+    reset_feeds(bot.DB, epoch)
+    ansa.published_at = time.time()
+    start = time.perf_counter()
+    publisher = asyncio.create_task(bot.update_and_publish_rss())
+    while len(tg.deliveries) < expected and time.perf_counter() - start < timeout and not publisher.done():
+        await asyncio.sleep(0.2)
+    elapsed = time.perf_counter() - start
+    publisher.cancel()
+    try:
+        await publisher
+    except asyncio.CancelledError:
+        pass
+    latencies = [delivered - ansa.published_at for delivered in tg.deliveries.values()]
+    print(f"update_and_publish_rss: {len(tg.deliveries)}/{expected} deliveries, {tg.messages} messages "
+          f"in {elapsed:.2f}s -> {tg.messages / elapsed:.1f} messages/s, {tg.rejected} answered 429")
+    print(f"feed-to-delivery latency: p50 {percentile(latencies, 50):.2f}s, p99 {percentile(latencies, 99):.2f}s")
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--categories", type=int, default=10)
+    arg_parser.add_argument("--items", type=int, default=5, help="articles per feed")
+    arg_parser.add_argument("--overlap", type=float, default=0.3, help="fraction of articles shared between feeds")
+    arg_parser.add_argument("--article-latency", type=float, default=0.05, help="seconds to serve an article page")
+    arg_parser.add_argument("--chats", type=int, default=50)
+    arg_parser.add_argument("--subs", type=int, default=2, help="categories enabled in every chat")
+    arg_parser.add_argument("--group-ratio", type=float, default=0.0, help="fraction of chats that are groups")
+    arg_parser.add_argument("--digest", type=int, default=0, help="minutes between the digests of every chat (0 = off)")
+    arg_parser.add_argument("--tg-global-rate", type=float, default=30)
+    arg_parser.add_argument("--tg-private-rate", type=float, default=1)
+    arg_parser.add_argument("--tg-group-rate", type=float, default=20 / 60)
+    arg_parser.add_argument("--timeout", type=float, default=600)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+
+    ansa = FakeAnsa(args.categories, args.items, args.overlap, args.article_latency, args.seed)
+    tg = FakeTelegram(args.tg_global_rate, args.tg_private_rate, args.tg_group_rate)
+    server = start_server(ansa, tg)
+    host = f"127.0.0.1:{server.server_address[1]}"
+    workdir = tempfile.mkdtemp(prefix="ansabench")
+    os.chdir(workdir)  # the bot logs into the working directory
+    subscriptions = generate_db(os.path.join(workdir, "bot.db"), host, args)
+    expected = len({(chat_id, art) for chat_id, cats in subscriptions.items()
+                    for cat in cats for art in ansa.feeds[cat - 1]})
+    epoch = int(ansa.published_at) - 3600
+
+    bot = Bot(TOKEN, db_name=os.path.join(workdir, "bot.db"), base_url=f"http://{host}/bot",
+              index_url=f"http://{host}/index")
+    for chat_id in subscriptions:
+        bot.DB.set_digest(chat_id, args.digest * 60)
+    asyncio.run(bench_parser(bot.DB, epoch, args.categories * args.items))
+    asyncio.run(bench_publisher(bot, ansa, tg, expected, epoch, args.timeout))
+    print(f"peak RSS memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB "
+          f"(benchmark servers included)")
+    bot.stop()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
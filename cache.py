@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class LruCache:
+    """ Size bounded mapping that evicts the least recently used key once 'maxsize' is reached
+        and treats entries older than 'ttl' seconds as missing (ttl=None never expires).
+        Safe to share between threads (the telegram dispatcher workers, the send pool) """
+    __slots__ = ["maxsize", "ttl", "hits", "misses", "_data", "_lock"]
+
+    def __init__(self, maxsize: int = 4096, ttl: float = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key: (insertion time, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return the cached value (refreshing its recency) or 'default', counting hits and misses """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            stored_at, value = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value) -> None:
+        """ Store value under key, evicting the least recently used entries beyond 'maxsize' """
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """ Return a dict with 'size', 'hits', 'misses' and 'hit_ratio' """
+        lookups = self.hits + self.misses
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+    def __contains__(self, key) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and (self.ttl is None or time.monotonic() - entry[0] <= self.ttl)
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,157 @@
+from database import Database
+from lxml import etree, html
+from urllib import parse
+import asyncio
+import logging
+import sqlite3
+import httpx
+import json
+import os
+
+ANSA_RSS_INDEX = "https://www.ansa.it/sito/static/ansa_rss.html"
+
+
+def parse_rss_index(content: bytes, index_url: str = ANSA_RSS_INDEX) -> dict:
+    """ Return the feeds listed in the ANSA rss index page as a dict 'category name: feed url',
+        in page order. Every '<dd>' holds two '<li>': the category name and the 'b-rss' feed link """
+    url_parsed = parse.urlparse(index_url)
+    feeds = {}
+    root = html.fromstring(content)
+    for dd in root.xpath("//dd"):
+        li_list = dd.xpath("ul//li")
+        anchors = li_list[0].xpath("a") if len(li_list) == 2 else []
+        links = li_list[1].xpath("a[@class='b-rss']") if len(li_list) == 2 else []
+        texts = [t for t in anchors[0].itertext()] if anchors else []
+        if len(texts) < 2 or not links:
+            logging.warning(f"Unexpected entry in the rss index: {etree.tostring(dd)[:200]!r}")
+            continue
+        feeds[texts[1]] = f"{url_parsed.scheme}://{url_parsed.netloc}/{links[0].attrib['href']}"
+    return feeds
+
+
+class Catalogue:
+    """ The categories offered by the bot, read from the database at startup (or from the snapshot
+        of the last index seen, when the database is new) so no request is needed to start,
+        and kept in sync with the ANSA rss index by 'run' in the background """
+    __slots__ = ["db", "index_url", "snapshot_path", "names", "ids", "version", "listeners"]
+
+    def __init__(self, db: Database, snapshot_path: str = "catalogue.json", index_url: str = ANSA_RSS_INDEX):
+        """ snapshot_path = json copy of the last index fetched, used to fill a new database offline """
+        self.db = db
+        self.index_url = index_url
+        self.snapshot_path = snapshot_path
+        self.names = {}  # category_id: name of the active categories
+        self.ids = {}  # name: category_id of the active categories
+        self.version = 0  # bumped at every change of the active categories
+        self.listeners = []  # called with the catalogue after every change
+        self.load()
+
+    def load(self) -> None:
+        """ Rebuild the maps from the database, seeding an empty database from the snapshot """
+        if not self.db.get_catalogue():
+            snapshot = self._read_snapshot()
+            if snapshot:
+                self.db.update_catalogue(list(snapshot.items()), [], [], [], [])
+                logging.info(f"{len(snapshot)} categories loaded from {self.snapshot_path}")
+        self._rebuild()
+
+    def add_listener(self, listener) -> None:
+        self.listeners.append(listener)
+
+    def _rebuild(self) -> None:
+        self.names = {catid: name for catid, name, _, active in self.db.get_catalogue() if active}
+        self.ids = {name: catid for catid, name in self.names.items()}
+        self.version += 1
+        for listener in self.listeners:
+            listener(self)
+
+    def _read_snapshot(self) -> dict:
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                return dict(json.load(f))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"{e!r} reading the catalogue snapshot {self.snapshot_path}, ignoring it")
+            return {}
+
+    def _write_snapshot(self, feeds: dict) -> None:
+        """ Written aside and renamed so a crash never leaves half a snapshot """
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(list(feeds.items()), f, ensure_ascii=False, indent=0)
+        os.replace(tmp_path, self.snapshot_path)
+
+    async def refresh(self, client: httpx.AsyncClient, timeout: float = 30.0) -> bool:
+        """ Conditional GET of the rss index, apply its changes to the database. Return whether it changed """
+        catalogue = self.db.get_catalogue()
+        headers = {}
+        if catalogue:  # an empty database needs the index even if it did not change
+            etag = self.db.get_setting("catalogue_etag")
+            last_modified = self.db.get_setting("catalogue_last_modified")
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        resp = await client.get(self.index_url, headers=headers, timeout=timeout)
+        if resp.status_code == 304:
+            return False
+        resp.raise_for_status()
+        feeds = parse_rss_index(resp.content, self.index_url)
+        if not feeds:
+            logging.warning(f"No feed found in {self.index_url}, keeping the current catalogue")
+            return False
+        changed = self._apply(catalogue, feeds)
+        self._write_snapshot(feeds)
+        # the validators are kept only once the index has been applied
+        self.db.put_setting("catalogue_etag", resp.headers.get("etag"))
+        self.db.put_setting("catalogue_last_modified", resp.headers.get("last-modified"))
+        if changed:
+            self._rebuild()
+        return changed
+
+    def _apply(self, catalogue: list, feeds: dict) -> bool:
+        """ Diff the index against the 'categories' rows, a feed is matched by url first
+            (the category was renamed) then by name (the feed moved). Return whether anything changed """
+        by_feed = {feed: (catid, name, active) for catid, name, feed, active in catalogue}
+        by_name = {name: (catid, feed, active) for catid, name, feed, active in catalogue}
+        fetched = set(feeds.values())
+        added, renamed, moved, reactivated = [], [], [], []
+        matched = set()
+        for name, feed in feeds.items():
+            if feed in by_feed:
+                catid, old_name, active = by_feed[feed]
+                if old_name != name:
+                    renamed.append((name, catid))
+            elif name in by_name and by_name[name][1] not in fetched:
+                catid, _, active = by_name[name]
+                moved.append((feed, catid))
+            else:
+                added.append((name, feed))
+                continue
+            matched.add(catid)
+            if not active:
+                reactivated.append(catid)
+        deactivated = [catid for catid, _, _, active in catalogue if active and catid not in matched]
+        if not (added or renamed or moved or deactivated or reactivated):
+            return False
+        self.db.update_catalogue(added, renamed, moved, deactivated, reactivated)
+        logging.info(f"Catalogue updated: {len(added)} added, {len(renamed)} renamed, {len(moved)} moved, "
+                     f"{len(deactivated)} removed, {len(reactivated)} back")
+        return True
+
+    async def run(self, client: httpx.AsyncClient, interval: float = 6 * 3600, retry: float = 300) -> None:
+        """ Refresh the catalogue every 'interval' seconds, or after 'retry' seconds when the index
+            could not be read; the bot keeps serving the categories it already has meanwhile """
+        while True:
+            try:
+                await self.refresh(client)
+            except (httpx.HTTPError, etree.Error, ValueError, OSError, sqlite3.Error) as e:
+                logging.warning(f"{e!r} refreshing the catalogue from {self.index_url}, retrying in {retry}s")
+                await asyncio.sleep(retry)
+                continue
+            except Exception:  # the bot must not lose its catalogue refresh to a bug
+                logging.exception(f"Unexpected error refreshing the catalogue, retrying in {retry}s")
+                await asyncio.sleep(retry)
+                continue
+            await asyncio.sleep(interval)
@@ -1,3 +1,6 @@
+from .subscriptions import SubscriptionIndex
+from .chatnames import ChatNameCache
+from .filters import FilterIndex
 from .db import Database
 
-__all__ = ["Database"]
+__all__ = ["Database", "SubscriptionIndex", "ChatNameCache", "FilterIndex"]
@@ -0,0 +1,48 @@
+import threading
+
+
+class ChatNameCache:
+    """ In-memory copy of 'channels' (chat_id -> chat name), so the name carried by every message
+        is checked without a query; renames are kept aside until 'drain' hands them to the database """
+    __slots__ = ["_names", "_dirty", "_lock"]
+
+    def __init__(self, rows=()):
+        self._names = dict(rows)  # channel_id: channel_name
+        self._dirty = {}  # channel_id: channel_name not written yet
+        self._lock = threading.Lock()
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self._names
+
+    def get(self, channel_id: int):
+        return self._names.get(channel_id)
+
+    def put(self, channel_id: int, name: str, dirty: bool = False) -> None:
+        """ Remember the name of the chat, dirty = the database still has the old one """
+        with self._lock:
+            self._names[channel_id] = name
+            if dirty:
+                self._dirty[channel_id] = name
+            else:
+                self._dirty.pop(channel_id, None)
+
+    def channel_ids(self) -> list:
+        return list(self._names)
+
+    def forget(self, channel_id: int) -> None:
+        with self._lock:
+            self._names.pop(channel_id, None)
+            self._dirty.pop(channel_id, None)
+
+    def drain(self) -> list:
+        """ Return and clear the pending renames as '(channel_name, channel_id)' tuples """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        return [(name, channel_id) for channel_id, name in dirty.items()]
+
+    def restore(self, renames: list) -> None:
+        """ Put back the renames of a failed 'drain' unless the chat was renamed again meanwhile """
+        with self._lock:
+            for name, channel_id in renames:
+                if channel_id in self._names and channel_id not in self._dirty:
+                    self._dirty[channel_id] = name
@@ -1,14 +1,91 @@
-from urllib import parse
-from io import StringIO
+from .subscriptions import SubscriptionIndex
+from .chatnames import ChatNameCache
+from .filters import FilterIndex
+from keywords import normalize, STOPWORDS
+from metrics import DB_QUERY_SECONDS
+from contextlib import contextmanager
 from os import makedirs
-from lxml import etree
-import requests
+import threading
 import sqlite3
 import logging
 import time
 
 loggers = {}
 
+# schema steps applied in order by 'Database._migrate', one list of statements per version
+MIGRATIONS = [
+    [  # 1: conditional GET validators of every feed
+        "ALTER TABLE categories ADD COLUMN etag TEXT",
+        "ALTER TABLE categories ADD COLUMN last_modified TEXT",
+    ],
+    [  # 2: metadata of the scraped articles, keyed by canonical link
+        "CREATE TABLE IF NOT EXISTS article_metas "
+        "(link TEXT PRIMARY KEY, title TEXT, descr TEXT, img TEXT, url TEXT, fetched_at INTEGER)",
+    ],
+    [  # 3: every news delivered to every chat, replaces 'channel_categories.last_news'
+        "CREATE TABLE IF NOT EXISTS delivered_news "
+        "(channel_id INTEGER, news_hash TEXT, delivered_at INTEGER, PRIMARY KEY(channel_id, news_hash)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS delivered_news_delivered_at ON delivered_news (delivered_at)",
+    ],
+    [  # 4: telegram file_id of the uploaded article images
+        "CREATE TABLE IF NOT EXISTS photo_file_ids (img TEXT PRIMARY KEY, file_id TEXT, uploaded_at INTEGER)",
+        "CREATE INDEX IF NOT EXISTS photo_file_ids_uploaded_at ON photo_file_ids (uploaded_at)",
+    ],
+    [  # 5: adaptive polling schedule of every feed
+        "ALTER TABLE categories ADD COLUMN poll_interval INTEGER DEFAULT 600",
+        "ALTER TABLE categories ADD COLUMN last_polled INTEGER DEFAULT 0",
+        "ALTER TABLE categories ADD COLUMN next_poll INTEGER DEFAULT 0",
+    ],
+    [  # 6: secondary indexes of the per cycle lookups
+        "CREATE INDEX IF NOT EXISTS channel_categories_category_id ON channel_categories (category_id)",
+        "CREATE INDEX IF NOT EXISTS categories_next_poll ON categories (next_poll)",
+    ],
+    [  # 7: durable outbox drained by the delivery workers, one payload per news shared by every chat
+        "CREATE TABLE IF NOT EXISTS news_payloads (news_hash TEXT PRIMARY KEY, payload TEXT, created_at INTEGER)",
+        "CREATE TABLE IF NOT EXISTS outbox "
+        "(outbox_id INTEGER PRIMARY KEY AUTOINCREMENT, channel_id INTEGER NOT NULL, news_hash TEXT NOT NULL, "
+        "priority INTEGER DEFAULT 0, created_at INTEGER, attempts INTEGER DEFAULT 0, "
+        "lease_owner TEXT, lease_until INTEGER DEFAULT 0, UNIQUE(channel_id, news_hash))",
+        "CREATE INDEX IF NOT EXISTS outbox_lease_until ON outbox (lease_until)",
+        "CREATE INDEX IF NOT EXISTS outbox_lease_owner ON outbox (lease_owner)",
+    ],
+    [  # 8: feeds dropped from the ANSA index are kept (with their subscriptions) but no longer polled
+        "ALTER TABLE categories ADD COLUMN active INTEGER DEFAULT 1",
+        "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)",
+    ],
+    [  # 9: chats in digest mode get their news collected every digest_interval seconds
+        "ALTER TABLE channels ADD COLUMN digest_interval INTEGER DEFAULT 0",
+        "ALTER TABLE channels ADD COLUMN digest_sent INTEGER DEFAULT 0",
+    ],
+    [  # 10: consecutive failed polls of every feed, the circuit breaker of 'PollScheduler' opens on them
+        "ALTER TABLE categories ADD COLUMN failures INTEGER DEFAULT 0",
+        "ALTER TABLE categories ADD COLUMN last_error TEXT",
+    ],
+    [  # 11: keywords a chat wants (exclude = 0) or doesn't want (exclude = 1) in its news
+        "CREATE TABLE IF NOT EXISTS chat_filters "
+        "(channel_id INTEGER, keyword TEXT, exclude INTEGER DEFAULT 0, UNIQUE(channel_id, keyword, exclude))",
+    ],
+    [  # 12: archive of the published news, full-text indexed (FTS5, kept in sync by triggers) for '/search'
+        "CREATE TABLE IF NOT EXISTS archive (archive_id INTEGER PRIMARY KEY, news_hash TEXT UNIQUE, "
+        "title TEXT, descr TEXT, link TEXT, published_at INTEGER)",
+        "CREATE INDEX IF NOT EXISTS archive_published_at ON archive (published_at)",
+        "CREATE TABLE IF NOT EXISTS archive_categories "
+        "(archive_id INTEGER, category_id INTEGER, PRIMARY KEY(archive_id, category_id)) WITHOUT ROWID",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(title, descr, content='archive', "
+        "content_rowid='archive_id', tokenize='unicode61 remove_diacritics 2')",
+        "INSERT INTO archive_fts (archive_fts, rank) VALUES ('rank', 'bm25(4.0, 1.0)')",  # a title hit weighs more
+        "CREATE TRIGGER IF NOT EXISTS archive_insert AFTER INSERT ON archive BEGIN "
+        "INSERT INTO archive_fts (rowid, title, descr) VALUES (new.archive_id, new.title, new.descr); END",
+        "CREATE TRIGGER IF NOT EXISTS archive_delete AFTER DELETE ON archive BEGIN "
+        "INSERT INTO archive_fts (archive_fts, rowid, title, descr) VALUES ('delete', old.archive_id, old.title, old.descr); "
+        "DELETE FROM archive_categories WHERE archive_id = old.archive_id; END",
+    ],
+]
+
+# shard of the chat among '?' shards, as python's 'channel_id % shards': SQLite's '%' keeps the sign
+# of the dividend and the ids of groups and channels are negative
+SHARD_OF_CHAT = "((channel_id % ?) + ?) % ?"
+
 
 def logger_cfg(name, filename, level=logging.DEBUG,
                formatter='%(asctime)s||%(levelname)s||%(name)s||%(message)s'):
@@ -33,145 +110,165 @@ def logger_cfg(name, filename, level=logging.DEBUG,
 
 
 class Database:
-    __slots__ = ['_db', 'cursor', 'db_logger', 'ansa_url']
+    """ Every thread (the telegram dispatcher workers, the asyncio publisher, the send pool)
+        gets its own connection to the same WAL database, so readers never wait for the writer """
+    __slots__ = ['_name', '_local', '_connections', '_lock', 'db_logger', 'subscriptions', 'chat_names', 'filters']
 
-    def __init__(self, name):
-        self._db = sqlite3.connect(name, check_same_thread=False)
+    def __init__(self, name, catchup_window: int = None):
+        """ catchup_window = at startup, news older than this many seconds are not recovered
+            (None leaves the feed epochs untouched, as the delivery workers do) """
+        self._name = name
+        self._local = threading.local()  # connection, cursor and transaction depth of the current thread
+        self._connections = []  # every connection opened, closed together by 'close'
+        self._lock = threading.Lock()
         self.db_logger = logger_cfg("DATABASE", 'db.log')
-        self.ansa_url = "https://www.ansa.it/sito/static/ansa_rss.html"
-        self._initialize()
+        self._initialize(catchup_window)
+        self.exec("SELECT channel_id, category_id FROM channel_categories")
+        self.subscriptions = SubscriptionIndex(self.cursor.fetchall())
+        self.exec("SELECT channel_id, channel_name FROM channels")
+        self.chat_names = ChatNameCache(self.cursor.fetchall())
+        self.exec("SELECT channel_id, keyword, exclude FROM chat_filters")
+        self.filters = FilterIndex(self.cursor.fetchall())
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self._name, timeout=30, check_same_thread=False)
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")  # durable at every checkpoint, enough with WAL
+        self._local.db = db
+        self._local.cursor = db.cursor()
+        self._local.depth = 0
+        with self._lock:
+            self._connections.append(db)
+        return db
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        """ Connection of the current thread """
+        db = getattr(self._local, 'db', None)
+        return db if db is not None else self._connect()
+
+    @property
+    def cursor(self) -> sqlite3.Cursor:
+        """ Cursor of the current thread connection """
+        if getattr(self._local, 'db', None) is None:
+            self._connect()
+        return self._local.cursor
 
-    def _initialize(self):
+    def _initialize(self, catchup_window: int = None):
         """ Channel_categories = for unique pairs of enabled categories in each chat (channel_id, category_id)
             categories = for storing categories and their state of feed
             channels = for storing channels list and IDs
         """
-        self.cursor = self._db.cursor()
         self.cursor.execute("CREATE TABLE IF NOT EXISTS channel_categories "
                             "(channel_id INTEGER, category_id INTEGER, last_news TEXT, UNIQUE(channel_id, category_id))")
         self.cursor.execute("CREATE TABLE IF NOT EXISTS categories "
                             "(category_id INTEGER PRIMARY KEY AUTOINCREMENT DEFAULT 0, name TEXT, feed TEXT, epoch INTEGER DEFAULT 0)")
         self.cursor.execute("CREATE TABLE IF NOT EXISTS channels "
                             "(channel_id INTEGER PRIMARY KEY NOT NULL, channel_name TEXT)")
-        self.exec("SELECT feed FROM categories")
-        fetched_feed = self.cursor.fetchall()
-        if not fetched_feed:
+        self._migrate()
+        # the feeds themselves are filled in (and kept up to date) by 'catalogue.Catalogue'
+        if catchup_window is not None:
+            self._limit_catchup(catchup_window)
+
+    def _migrate(self):
+        """ Apply every schema step newer than the database 'user_version',
+            so databases created by older releases gain the new columns in place.
+            Every step runs in its own BEGIN IMMEDIATE transaction and the version is read again
+            once the lock is held: processes started together on an old database (the publisher
+            and the 'delivery.py' workers) apply each step once, the others find it done """
+        while True:
+            self.exec("BEGIN IMMEDIATE")
             try:
-                self.db_logger.info('Populating database...')
-                self.populate_rss_urls()
-            except sqlite3.Error as e:
-                self.db_logger.warning(f'{e}: occurred while populating feeds')
-            else:
-                self.db_logger.info("Database feeds populated correctly")
-        else:
-            self._update_epoch()
+                self.exec("PRAGMA user_version")
+                version = self.cursor.fetchone()[0]
+                if version < len(MIGRATIONS):
+                    for statement in MIGRATIONS[version]:
+                        self.exec(statement)
+                    self.exec(f"PRAGMA user_version = {version + 1}")
+            except BaseException:
+                self._db.rollback()
+                raise
+            self._db.commit()
+            if version >= len(MIGRATIONS):
+                return
+            self.db_logger.info(f'Database schema migrated to version {version + 1}')
 
-    @staticmethod
-    def http_request(url):
-        """ Only used for 'populate_rss_feeds' """
-        try:
-            resp = requests.get(url)
-            return resp, True
-        except requests.exceptions.RequestException as e:
-            print(f"Error while requesting: {url}! -> {e}")
-            return None, False
-
-    def populate_rss_urls(self):
-        """ Only used to populate database 'feed' and 'epoch' columns
-            with urls and current epoch in database table 'categories' """
-        ansa_url = self.ansa_url
-        url_parsed = parse.urlparse(ansa_url)
-        lista_feed = {}
-        resp, done = self.http_request(ansa_url)
-        if not done:
-            raise Exception("Error while requesting http page")
-        parser = etree.HTMLParser()
-        root = etree.parse(StringIO(resp.text), parser)
-        dd_list = root.xpath("//dd")
-        for dd in dd_list:
-            self.get_urls_to_db(dd, url_parsed, lista_feed)
-        [self.exec("INSERT INTO categories (name, feed, epoch) VALUES (?, ?, ?)",
-                   [key, url, int(time.time())])
-         for key, url in lista_feed.items()]
+    def _limit_catchup(self, catchup_window: int):
+        """ Move forward the epoch of the feeds not polled for more than catchup_window seconds,
+            the news published while the bot was down are recovered only within the window """
+        self.exec("UPDATE categories SET epoch = ? WHERE epoch < ?",
+                  [int(time.time()) - catchup_window] * 2)
         self.commit()
 
-    @staticmethod
-    def get_urls_to_db(dd, url_parsed, lista_feed):
-        """ Fill database with urls """
-        li_list = dd.xpath("ul//li")
-        if len(li_list) != 2:
-            raise Exception("Bad li_list")
-        else:
-            cat_name = li_list[0].xpath("a")[0]
-            texts = [t for t in cat_name.itertext()]
-            link = li_list[1].xpath("a[@class='b-rss']")[0]
-            lista_feed.update({texts[1]: f"{url_parsed.scheme}://{url_parsed.hostname}/{link.attrib['href']}"})
-
-    def _update_epoch(self):
-        self.exec("UPDATE categories SET epoch = ?", [int(time.time())])
+    def prune_delivered(self, max_age: int = 7 * 24 * 3600) -> None:
+        """ DELETE the delivery records older than max_age seconds,
+            feeds never carry news that old so they can't be sent twice anyway """
+        self.exec("DELETE FROM delivered_news WHERE delivered_at <= ?", [int(time.time()) - max_age])
         self.commit()
 
-    def _update_last_news_into_channel_categories(self, title: str, cat_id: int, channel_id: int) -> None:
-        """ Insert last news title in its category """
-        self.exec("UPDATE channel_categories SET last_news = ? WHERE (category_id = ? AND channel_id = ?)",
-                  [title, cat_id, channel_id])
+    def channel_update_or_insert(self, chat_id: int, chat_name: str) -> None:
+        """ Add the new chat in the table or update chat name if chat_id doesn't match,
+            renames are only cached here and written by 'flush_chat_names' """
+        cached = self.chat_names.get(chat_id)
+        if cached == chat_name:  # chat_id & chat_name matches in db
+            return
+        if chat_id in self.chat_names:  # chat_name & chat_id don't match in db
+            self.db_logger.info(f'{cached} changed name into {chat_name}')
+            self.chat_names.put(chat_id, chat_name, dirty=True)
+            return
+        # new chats are written at once, the other tables refer to them
+        self.exec("INSERT OR IGNORE INTO channels (channel_id, channel_name) VALUES (?, ?)",
+                  [chat_id, chat_name])
         self.commit()
+        self.chat_names.put(chat_id, chat_name)
 
-    def check_last_news(self, channel_id: int, news_title: str, cat_id: int) -> bool:
-        """ Check if the news is already been published in the chat """
-        self.exec("SELECT category_id  FROM channel_categories WHERE channel_id = ?",
-                  [channel_id])
-        fetched = self.cursor.fetchall()
-        active_categories = [x[0] for x in fetched]
-        self.exec("SELECT category_id, last_news FROM channel_categories")
-        catid_lastnews = {x[0]: x[1] for x in self.cursor.fetchall()}
-        for catid in active_categories:
-            if catid_lastnews[catid] == news_title:
-                return True
-        self._update_last_news_into_channel_categories(news_title, cat_id, channel_id)
-        return False
+    def flush_chat_names(self) -> None:
+        """ Write the chat renames collected by 'channel_update_or_insert' in a single transaction """
+        renames = self.chat_names.drain()
+        if not renames:
+            return
+        try:
+            with self.transaction():
+                self.execmany("UPDATE channels SET channel_name = ? WHERE channel_id = ?", renames)
+        except sqlite3.Error as e:
+            logging.warning(f'{e} occurred while updating {len(renames)} chat names in db, retrying later')
+            self.chat_names.restore(renames)
 
-    def channel_update_or_insert(self, chat_id: int, chat_name: str) -> None:
-        """ Add the new chat in the table or update chat name if chat_id doesn't match """
-        self.exec("SELECT channel_id, channel_name FROM channels WHERE channel_id = ?", [chat_id])
+    def set_digest(self, chat_id: int, interval: int) -> None:
+        """ Collect the news of the chat in a digest every 'interval' seconds, 0 sends them one by one """
+        self.exec("UPDATE channels SET digest_interval = ? WHERE channel_id = ?", [interval, chat_id])
+        self.commit()
+
+    def get_digest(self, chat_id: int) -> int:
+        """ Digest interval of the chat in seconds, 0 if the chat gets every news on its own """
+        self.exec("SELECT digest_interval FROM channels WHERE channel_id = ?", [chat_id])
         fetched = self.cursor.fetchone()
-        if fetched:  # chat_id found in db
-            if chat_name != fetched[1]:  # chat_name & chat_id don't match in db
-                try:
-                    self.db_logger.info(f'{fetched[1]} changed name into {chat_name}')
-                    self.exec("UPDATE channels SET channel_name = ? WHERE channel_id = ?", [chat_name, chat_id])
-                except sqlite3.Error as e:
-                    logging.warning(e)
-                except Exception as e:
-                    logging.warning(f'{e.args} occurred while updating chat_name in db')
-                else:
-                    self.commit()
-            else:  # chat_id & chat_name matches in db
-                pass
-        else:
-            self.exec("INSERT INTO channels (channel_id, channel_name) VALUES (?, ?)",
-                      [chat_id, chat_name])
-            self.commit()
+        return fetched[0] or 0 if fetched else 0
+
+    def _names_ids(self, cats_ids: list) -> list:
+        """ Return '(name, category_id)' of the valid ids among cats_ids, in the given order (one query) """
+        self.exec(f"SELECT name, category_id FROM categories WHERE category_id IN ({', '.join('?' * len(cats_ids))})",
+                  cats_ids)
+        names_ids = {str(cat_id): (name, cat_id) for name, cat_id in self.cursor.fetchall()}
+        return [names_ids[str(cat)] for cat in cats_ids if str(cat) in names_ids]
 
     def enable_cat(self, chat_id: int, cats_ids: list) -> list:
         """ INSERT the row that matches specified category(id)
             with the chat(id) which called the '/enable' command """
         if type(cats_ids[0]) is str and cats_ids[0] == "all":
-            self.execmany("INSERT OR IGNORE INTO channel_categories (channel_id, category_id) VALUES (?, ?)",
-                          [(chat_id, i) for i in range(1, 50)])
+            self.exec("INSERT OR IGNORE INTO channel_categories (channel_id, category_id) "
+                      "SELECT ?, category_id FROM categories WHERE active = 1", [chat_id])
             self.commit()
+            self.exec("SELECT category_id FROM categories WHERE active = 1")
+            self.subscriptions.add(chat_id, [x[0] for x in self.cursor.fetchall()])
             return ["all categories"]
         else:
-            added = []
-            for cat in cats_ids:
-                self.exec("SELECT name, category_id FROM categories WHERE category_id = ?", [cat])
-                name_id = self.cursor.fetchone()
-                if name_id:
-                    added.append(name_id[0])
-                    cat_id = name_id[1]
-                    self.exec("INSERT OR IGNORE INTO channel_categories (channel_id, category_id) VALUES (?, ?)", [chat_id, cat_id])
-                    self.commit()
-            return added
+            names_ids = self._names_ids(cats_ids)
+            with self.transaction():
+                self.execmany("INSERT OR IGNORE INTO channel_categories (channel_id, category_id) VALUES (?, ?)",
+                              [(chat_id, cat_id) for _, cat_id in names_ids])
+            self.subscriptions.add(chat_id, [cat_id for _, cat_id in names_ids])
+            return [name for name, _ in names_ids]
 
     def disable_cat(self, chat_id, cats_ids: list) -> list:
         """ DELETE the row that matches specified category(id)
@@ -180,33 +277,59 @@ class Database:
             self.exec("DELETE FROM channel_categories WHERE channel_id = ?",
                       [chat_id])
             self.commit()
+            self.subscriptions.remove_channel(chat_id)
             return ["any category"]
         else:
-            deleted = []
-            for cat in cats_ids:
-                self.exec("SELECT name, category_id FROM categories WHERE category_id = ?", [cat])
-                name_id = self.cursor.fetchone()
-                if name_id:
-                    cat_name = name_id[0]
-                    cat_id = name_id[1]
-                    self.exec("DELETE FROM channel_categories WHERE (channel_id = ? AND category_id = ?)",
-                              [chat_id, cat_id])
-                    self.commit()
-                    deleted.append(cat_name)
-            return deleted
-
-    def cat_list(self, chat_id: int) -> list:
-        """ List all active categories feeds in the channel """
-        self.exec("SELECT category_id FROM channel_categories WHERE channel_id = ?", [chat_id])
-        active_categories = self.cursor.fetchall()
-        fetched = [x[0] for x in active_categories]
-        actives_list = []
-        for cat_id in fetched:
-            self.exec("SELECT name FROM categories WHERE category_id = ?",
-                      [cat_id])
-            cat_name = self.cursor.fetchone()
-            actives_list.append(f"{cat_id}) {cat_name[0]}")
-        return actives_list
+            names_ids = self._names_ids(cats_ids)
+            with self.transaction():
+                self.execmany("DELETE FROM channel_categories WHERE (channel_id = ? AND category_id = ?)",
+                              [(chat_id, cat_id) for _, cat_id in names_ids])
+            self.subscriptions.remove(chat_id, [cat_id for _, cat_id in names_ids])
+            return [name for name, _ in names_ids]
+
+    def remove_chat(self, chat_id: int) -> None:
+        """ DELETE the chat and its subscriptions (the bot was kicked or blocked) """
+        with self.transaction():
+            self.exec("DELETE FROM channels WHERE channel_id = ?", [chat_id])
+            self.exec("DELETE FROM channel_categories WHERE channel_id = ?", [chat_id])
+            self.exec("DELETE FROM chat_filters WHERE channel_id = ?", [chat_id])
+        self.subscriptions.remove_channel(chat_id)
+        self.chat_names.forget(chat_id)
+        self.filters.remove_channel(chat_id)
+
+    def forget_removed_chats(self) -> list:
+        """ Drop from the in-memory indexes the chats another process removed (the 'delivery.py' workers
+            call 'remove_chat' on their own copy), return their ids """
+        # a chat enters the cache only once its row is committed, so the cache is read first
+        known = self.chat_names.channel_ids()
+        self.exec("SELECT channel_id FROM channels")
+        present = {row[0] for row in self.cursor.fetchall()}
+        removed = [chat_id for chat_id in known if chat_id not in present]
+        for chat_id in removed:
+            self.subscriptions.remove_channel(chat_id)
+            self.chat_names.forget(chat_id)
+            self.filters.remove_channel(chat_id)
+        return removed
+
+    def add_filters(self, chat_id: int, filters: list) -> list:
+        """ INSERT the '(keyword, exclude)' filters of the chat, keywords are stored normalized
+            (see 'keywords.normalize'). Return the rows added as '(keyword, exclude)' """
+        rows = list(dict.fromkeys((normalize(keyword).strip(), bool(exclude)) for keyword, exclude in filters))
+        with self.transaction():
+            self.execmany("INSERT OR IGNORE INTO chat_filters (channel_id, keyword, exclude) VALUES (?, ?, ?)",
+                          [(chat_id, keyword, exclude) for keyword, exclude in rows])
+        self.filters.add([(chat_id, keyword, exclude) for keyword, exclude in rows])
+        return rows
+
+    def remove_filters(self, chat_id: int, keywords: list) -> list:
+        """ DELETE the filters of the chat on the keywords (include or exclude), return the keywords removed """
+        existing = {keyword for keyword, _ in self.filters.filters(chat_id)}
+        removed = [keyword for keyword in dict.fromkeys(normalize(k).strip() for k in keywords) if keyword in existing]
+        with self.transaction():
+            self.execmany("DELETE FROM chat_filters WHERE channel_id = ? AND keyword = ?",
+                          [(chat_id, keyword) for keyword in removed])
+        self.filters.remove(chat_id, removed)
+        return removed
 
     def update_epoch(self, item_epoch: int, cat_id: int) -> None:
         """ UPDATE the last feed publication date (as epoch) in database
@@ -219,6 +342,250 @@ class Database:
         else:
             self.commit()
 
+    def get_catalogue(self) -> list:
+        """ Return every category as a tuple '(category_id, name, feed, active)' """
+        self.exec("SELECT category_id, name, feed, active FROM categories ORDER BY category_id")
+        return self.cursor.fetchall()
+
+    def update_catalogue(self, added: list, renamed: list, moved: list, deactivated: list, reactivated: list) -> None:
+        """ Apply a diff of the ANSA feeds index to 'categories' in a single transaction
+            added = list of '(name, feed)', renamed = list of '(name, category_id)',
+            moved = list of '(feed, category_id)', deactivated and reactivated = lists of category_id """
+        now = int(time.time())
+        with self.transaction():
+            self.execmany("INSERT INTO categories (name, feed, epoch) VALUES (?, ?, ?)",
+                          [(name, feed, now) for name, feed in added])
+            self.execmany("UPDATE categories SET name = ? WHERE category_id = ?", renamed)
+            self.execmany("UPDATE categories SET feed = ?, etag = NULL, last_modified = NULL WHERE category_id = ?",
+                          moved)
+            self.execmany("UPDATE categories SET active = 0 WHERE category_id = ?", [(x,) for x in deactivated])
+            # a feed coming back starts from now, not from when it disappeared
+            self.execmany("UPDATE categories SET active = 1, epoch = MAX(epoch, ?) WHERE category_id = ?",
+                          [(now, x) for x in reactivated])
+
+    def get_setting(self, key: str, default: str = None):
+        self.exec("SELECT value FROM settings WHERE key = ?", [key])
+        fetched = self.cursor.fetchone()
+        return fetched[0] if fetched else default
+
+    def put_setting(self, key: str, value: str) -> None:
+        self.exec("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", [key, value])
+        self.commit()
+
+    def update_validators(self, cat_id: int, etag: str, last_modified: str) -> None:
+        """ UPDATE the 'ETag' and 'Last-Modified' headers of the last feed response,
+            sent back as 'If-None-Match' and 'If-Modified-Since' on the next poll """
+        try:
+            self.exec("UPDATE categories SET etag = ?, last_modified = ? WHERE category_id = ?",
+                      [etag, last_modified, cat_id])
+        except sqlite3.Error as e:
+            logging.warning(f'{e}: error in updating feed validators in database')
+        else:
+            self.commit()
+
+    def update_poll_schedule(self, schedules: list) -> None:
+        """ UPDATE the polling schedule of the polled feeds, schedules = list of tuples
+            '(poll_interval, last_polled, next_poll, failures, last_error, category_id)' """
+        try:
+            self.execmany("UPDATE categories SET poll_interval = ?, last_polled = ?, next_poll = ?, "
+                          "failures = ?, last_error = ? WHERE category_id = ?", schedules)
+        except sqlite3.Error as e:
+            logging.warning(f'{e}: error in updating polling schedule in database')
+        else:
+            self.commit()
+
+    def failing_feeds(self, threshold: int) -> int:
+        """ How many active feeds failed at least 'threshold' polls in a row """
+        self.exec("SELECT COUNT(*) FROM categories WHERE active = 1 AND failures >= ?", [threshold])
+        return self.cursor.fetchone()[0]
+
+    def next_poll_at(self):
+        """ Return the epoch of the next feed to be polled, None if there are no feeds """
+        self.exec("SELECT MIN(next_poll) FROM categories WHERE active = 1")
+        return self.cursor.fetchone()[0]
+
+    def get_article_meta(self, link: str, max_age: int):
+        """ Return the stored '(title, descr, img, url)' of the canonical link
+            if it was scraped less than max_age seconds ago, else None """
+        self.exec("SELECT title, descr, img, url FROM article_metas WHERE link = ? AND fetched_at > ?",
+                  [link, int(time.time()) - max_age])
+        return self.cursor.fetchone()
+
+    def put_article_meta(self, link: str, title_descr_img_link: tuple) -> None:
+        """ INSERT or replace the scraped metadata of the canonical link """
+        try:
+            self.exec("INSERT OR REPLACE INTO article_metas (link, title, descr, img, url, fetched_at) "
+                      "VALUES (?, ?, ?, ?, ?, ?)", [link, *title_descr_img_link, int(time.time())])
+        except sqlite3.Error as e:
+            logging.warning(f'{e}: error in storing article metadata in database')
+        else:
+            self.commit()
+
+    def prune_article_metas(self, max_age: int) -> None:
+        """ DELETE the article metadata scraped more than max_age seconds ago """
+        self.exec("DELETE FROM article_metas WHERE fetched_at <= ?", [int(time.time()) - max_age])
+        self.commit()
+
+    def enqueue_news(self, payloads: list, targets: list) -> None:
+        """ Durably queue news for the delivery workers, in a single transaction
+            payloads = list of tuples '(news_hash, payload)', stored once for every chat
+            targets = list of tuples '(channel_id, news_hash, priority)', news already
+            delivered to (or already queued for) the chat are skipped, as the chats removed
+            meanwhile by another process (see 'forget_removed_chats') """
+        now = int(time.time())
+        with self.transaction():
+            self.execmany("INSERT OR IGNORE INTO news_payloads (news_hash, payload, created_at) VALUES (?, ?, ?)",
+                          [(news_hash, payload, now) for news_hash, payload in payloads])
+            self.execmany("INSERT OR IGNORE INTO outbox (channel_id, news_hash, priority, created_at) "
+                          "SELECT ?, ?, ?, ? WHERE NOT EXISTS "
+                          "(SELECT 1 FROM delivered_news WHERE channel_id = ? AND news_hash = ?) "
+                          "AND EXISTS (SELECT 1 FROM channels WHERE channel_id = ?)",
+                          [(channel_id, news_hash, priority, now, channel_id, news_hash, channel_id)
+                           for channel_id, news_hash, priority in targets])
+
+    def claim_outbox(self, owner: str, shard: int, shards: int, limit: int, lease: int) -> list:
+        """ Lease up to 'limit' queued messages of the chats in the shard (channel_id % shards == shard)
+            to 'owner' for 'lease' seconds: unleased rows and rows whose lease expired
+            (their worker crashed) are taken, oldest first. The messages of a chat in digest mode
+            wait until digest_interval seconds have passed since its last digest.
+            Return a list of tuples '(outbox_id, channel_id, news_hash, attempts, payload, digest_interval)' """
+        now = int(time.time())
+        self.exec("BEGIN IMMEDIATE")  # no other process can claim the same rows in between
+        try:
+            self.exec(f"SELECT outbox_id FROM outbox WHERE lease_until < ? AND {SHARD_OF_CHAT} = ? "
+                      "AND channel_id NOT IN (SELECT channel_id FROM channels "
+                      "WHERE digest_interval > 0 AND digest_sent + digest_interval > ?) "
+                      "ORDER BY priority, outbox_id LIMIT ?", [now, shards, shards, shards, shard, now, limit])
+            ids = [x[0] for x in self.cursor.fetchall()]
+            self.execmany("UPDATE outbox SET lease_owner = ?, lease_until = ? WHERE outbox_id = ?",
+                          [(owner, now + lease, outbox_id) for outbox_id in ids])
+            # the digest window restarts as soon as its news are taken
+            self.exec("UPDATE channels SET digest_sent = ? WHERE digest_interval > 0 AND channel_id IN "
+                      "(SELECT channel_id FROM outbox WHERE lease_owner = ? AND lease_until = ?)",
+                      [now, owner, now + lease])
+        except BaseException:
+            self._db.rollback()
+            raise
+        self._db.commit()
+        if not ids:
+            return []
+        self.exec(f"SELECT outbox.outbox_id, outbox.channel_id, outbox.news_hash, outbox.attempts, news_payloads.payload, "
+                  f"IFNULL(channels.digest_interval, 0) "
+                  f"FROM outbox JOIN news_payloads ON news_payloads.news_hash = outbox.news_hash "
+                  f"LEFT JOIN channels ON channels.channel_id = outbox.channel_id "
+                  f"WHERE outbox.outbox_id IN ({', '.join('?' * len(ids))}) ORDER BY outbox.outbox_id", ids)
+        return self.cursor.fetchall()
+
+    def renew_leases(self, owner: str, lease: int) -> None:
+        """ Extend the lease of every message held by a live worker """
+        self.exec("UPDATE outbox SET lease_until = ? WHERE lease_owner = ?", [int(time.time()) + lease, owner])
+        self.commit()
+
+    def complete_outbox(self, outbox_id: int, channel_id: int, news_hash: str, sent: bool) -> None:
+        """ Remove a message from the outbox, recording the delivery if it was sent """
+        with self.transaction():
+            self.exec("DELETE FROM outbox WHERE outbox_id = ?", [outbox_id])
+            if sent:
+                self.exec("INSERT OR REPLACE INTO delivered_news (channel_id, news_hash, delivered_at) "
+                          "VALUES (?, ?, ?)", [channel_id, news_hash, int(time.time())])
+
+    def release_outbox(self, outbox_id: int, delay: int) -> None:
+        """ Give a message back to the shard, to be retried in 'delay' seconds """
+        self.exec("UPDATE outbox SET lease_owner = NULL, lease_until = ?, attempts = attempts + 1 "
+                  "WHERE outbox_id = ?", [int(time.time()) + delay, outbox_id])
+        self.commit()
+
+    def outbox_depth(self, shard: int = 0, shards: int = 1) -> int:
+        """ Messages still queued for the chats of the shard """
+        self.exec(f"SELECT COUNT(*) FROM outbox WHERE {SHARD_OF_CHAT} = ?", [shards, shards, shards, shard])
+        return self.cursor.fetchone()[0]
+
+    def prune_news_payloads(self, max_age: int = 24 * 3600) -> None:
+        """ DELETE the payloads older than max_age seconds no chat is waiting for anymore """
+        self.exec("DELETE FROM news_payloads WHERE created_at <= ? "
+                  "AND NOT EXISTS (SELECT 1 FROM outbox WHERE outbox.news_hash = news_payloads.news_hash)",
+                  [int(time.time()) - max_age])
+        self.commit()
+
+    def archive_news(self, rows: list) -> dict:
+        """ Add the published news to the searchable archive, in a single transaction
+            rows = list of tuples '(news_hash, category_id, title, descr, link, published_at)',
+            a news already archived only gains the new category.
+            Return '{category_id: news new to the category}', the ones archived before are not counted """
+        added = {}
+        with self.transaction():
+            self.execmany("INSERT OR IGNORE INTO archive (news_hash, title, descr, link, published_at) "
+                          "VALUES (?, ?, ?, ?, ?)", [(news_hash, title, descr, link, published_at)
+                                                     for news_hash, _, title, descr, link, published_at in rows])
+            by_category = {}
+            for news_hash, category_id, *_ in rows:
+                by_category.setdefault(category_id, []).append((category_id, news_hash))
+            for category_id, pairs in by_category.items():
+                self.execmany("INSERT OR IGNORE INTO archive_categories (archive_id, category_id) "
+                              "SELECT archive_id, ? FROM archive WHERE news_hash = ?", pairs)
+                added[category_id] = max(self.cursor.rowcount, 0)
+        return added
+
+    def search_archive(self, terms: list, category_id: int = None, limit: int = 5, offset: int = 0,
+                       window: int = 1000) -> list:
+        """ Archived news containing every term (a term of more words is a phrase), only the ones
+            of the category unless it is None. The 'window' most recent matches are ranked (bm25,
+            best first), so a common term costs a bounded number of rows instead of the whole archive;
+            stopwords are dropped from the terms unless nothing else is left.
+            Return a list of tuples '(title, descr, link, published_at)' """
+        terms = [term for term in terms if normalize(term) not in STOPWORDS] or terms
+        # every term quoted, the FTS5 query syntax (AND, NEAR, *, column:) can't come from the user
+        query = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+        if category_id is None:
+            where, args = "", [query, window, limit, offset]
+        else:
+            where = ("AND EXISTS (SELECT 1 FROM archive_categories c "
+                     "WHERE c.archive_id = archive_fts.rowid AND c.category_id = ?) ")
+            args = [query, category_id, window, limit, offset]
+        # archive_id grows with the publication, the rowid order of the index is the recency order
+        self.exec("SELECT a.title, a.descr, a.link, a.published_at FROM "
+                  f"(SELECT rowid, rank FROM archive_fts WHERE archive_fts MATCH ? {where}"
+                  "ORDER BY rowid DESC LIMIT ?) f "
+                  "JOIN archive a ON a.archive_id = f.rowid ORDER BY f.rank, f.rowid DESC LIMIT ? OFFSET ?", args)
+        return self.cursor.fetchall()
+
+    def prune_archive(self, max_age: int = 90 * 24 * 3600, merge_pages: int = 500) -> int:
+        """ DELETE the archived news older than max_age seconds, then let FTS5 merge up to
+            'merge_pages' pages of its index segments so the deleted entries are compacted away
+            a bit at a time instead of by a full 'optimize'. Return the news deleted """
+        with self.transaction():
+            self.exec("DELETE FROM archive WHERE published_at <= ?", [int(time.time()) - max_age])
+            deleted = self.cursor.rowcount
+            if deleted > 0:
+                self.exec("INSERT INTO archive_fts (archive_fts, rank) VALUES ('merge', ?)", [merge_pages])
+        return deleted
+
+    def get_photo_file_id(self, img: str):
+        """ Return the telegram file_id of the image url, None if it was never uploaded """
+        self.exec("SELECT file_id FROM photo_file_ids WHERE img = ?", [img])
+        fetched = self.cursor.fetchone()
+        return fetched[0] if fetched else None
+
+    def put_photo_file_id(self, img: str, file_id: str) -> None:
+        """ INSERT or replace the telegram file_id of the image url """
+        try:
+            self.exec("INSERT OR REPLACE INTO photo_file_ids (img, file_id, uploaded_at) VALUES (?, ?, ?)",
+                      [img, file_id, int(time.time())])
+        except sqlite3.Error as e:
+            logging.warning(f'{e}: error in storing photo file_id in database')
+        else:
+            self.commit()
+
+    def delete_photo_file_id(self, img: str) -> None:
+        self.exec("DELETE FROM photo_file_ids WHERE img = ?", [img])
+        self.commit()
+
+    def prune_photo_file_ids(self, max_age: int = 30 * 24 * 3600) -> None:
+        """ DELETE the file_ids uploaded more than max_age seconds ago,
+            their articles have left every feed long before """
+        self.exec("DELETE FROM photo_file_ids WHERE uploaded_at <= ?", [int(time.time()) - max_age])
+        self.commit()
+
     def chat_list(self):  # for unit testing
         """ Return a list of all chats in db """
         try:
@@ -230,21 +597,46 @@ class Database:
             return [x[0] for x in all_chats]
 
     def exec(self, query: str, *args):
-        """ Execute query """
-        return self.cursor.execute(query, *args)
+        """ Execute query (timed by statement kind) """
+        with DB_QUERY_SECONDS.time(statement=query.split(None, 1)[0].upper()):
+            return self.cursor.execute(query, *args)
 
     def execmany(self, query: str, *args):
-        """ Execute many query """
-        return self.cursor.executemany(query, *args)
+        """ Execute many query (timed by statement kind) """
+        with DB_QUERY_SECONDS.time(statement=query.split(None, 1)[0].upper()):
+            return self.cursor.executemany(query, *args)
 
     def commit(self):
-        """ Commit changes """
-        self._db.commit()
+        """ Commit changes, unless a 'transaction' of the current thread is open (it commits at its end) """
+        if not getattr(self._local, 'depth', 0):
+            self._db.commit()
+
+    @contextmanager
+    def transaction(self):
+        """ Group every write of the block into a single commit (rollback if the block raises),
+            never keep it open across an 'await': coroutines share the publisher thread connection """
+        db = self._db
+        self._local.depth += 1
+        try:
+            yield
+        except BaseException:
+            self._local.depth -= 1
+            if not self._local.depth:
+                db.rollback()
+            raise
+        else:
+            self._local.depth -= 1
+            if not self._local.depth:
+                db.commit()
 
     def close(self):
-        """ Close the connection with the database """
-        self.cursor.close()
-        self._db.close()
+        """ Close every connection with the database """
+        self.flush_chat_names()
+        with self._lock:
+            for db in self._connections:
+                db.close()
+            self._connections.clear()
+        self._local = threading.local()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,92 @@
+from keywords import KeywordMatcher, normalize
+import threading
+
+EMPTY = frozenset()
+
+
+class FilterIndex:
+    """ In-memory copy of 'chat_filters': the keywords a chat wants (include) or doesn't want (exclude)
+        in its news, indexed by keyword so an article is matched once against every keyword of every chat.
+        As in 'SubscriptionIndex' the sets are immutable and replaced on every write, the automaton
+        is rebuilt lazily, and only when a keyword no chat used before is added (or the last user goes away) """
+    __slots__ = ["_include", "_exclude", "_by_channel", "_includers", "_matcher", "_stale", "_lock"]
+
+    def __init__(self, rows=()):
+        self._include = {}  # keyword: frozenset of channel_id
+        self._exclude = {}  # keyword: frozenset of channel_id
+        self._by_channel = {}  # channel_id: frozenset of (keyword, exclude)
+        self._includers = EMPTY  # chats with at least one include keyword
+        self._matcher = KeywordMatcher()
+        self._stale = False  # the keywords changed since the matcher was built
+        self._lock = threading.Lock()
+        self.add(rows)
+
+    def filters(self, channel_id: int) -> frozenset:
+        """ '(keyword, exclude)' of the chat """
+        return self._by_channel.get(channel_id, EMPTY)
+
+    def add(self, rows) -> None:
+        """ Add '(channel_id, keyword, exclude)' rows """
+        with self._lock:
+            for channel_id, keyword, exclude in rows:
+                keyword, exclude = normalize(keyword), bool(exclude)
+                index = self._exclude if exclude else self._include
+                if keyword not in self._include and keyword not in self._exclude:
+                    self._stale = True
+                index[keyword] = index.get(keyword, EMPTY) | {channel_id}
+                self._by_channel[channel_id] = self._by_channel.get(channel_id, EMPTY) | {(keyword, exclude)}
+            self._includers = frozenset().union(*self._include.values())
+
+    def remove(self, channel_id: int, keywords) -> None:
+        """ Forget the keywords (include or exclude) of the chat """
+        with self._lock:
+            for keyword in keywords:
+                keyword = normalize(keyword)
+                for index in (self._include, self._exclude):
+                    channels = index.get(keyword, EMPTY) - {channel_id}
+                    if channels:
+                        index[keyword] = channels
+                    else:
+                        index.pop(keyword, None)
+                if keyword not in self._include and keyword not in self._exclude:
+                    self._stale = True
+                filters = {f for f in self._by_channel.get(channel_id, EMPTY) if f[0] != keyword}
+                if filters:
+                    self._by_channel[channel_id] = frozenset(filters)
+                else:
+                    self._by_channel.pop(channel_id, None)
+            self._includers = frozenset().union(*self._include.values())
+
+    def remove_channel(self, channel_id: int) -> None:
+        self.remove(channel_id, [keyword for keyword, _ in self.filters(channel_id)])
+
+    def _current_matcher(self) -> KeywordMatcher:
+        if self._stale:
+            with self._lock:
+                self._stale = False
+                self._matcher = KeywordMatcher(self._include.keys() | self._exclude.keys())
+        return self._matcher
+
+    def find(self, text: str) -> set:
+        """ Keywords of any chat found in the text (see 'allowed_by') """
+        if not self._by_channel:
+            return set()
+        return self._current_matcher().find(text)
+
+    def allowed(self, channels, text: str):
+        """ Return the chats among channels that want a news with this text: no excluded keyword in it
+            and, for the chats with include keywords, at least one of them """
+        return self.allowed_by(channels, self.find(text))
+
+    def allowed_by(self, channels, found: set):
+        """ 'allowed' from the keywords already found in the text, the text of a news carried by
+            several categories is scanned once """
+        if not self._by_channel:
+            return channels
+        excluded, included = set(), set()
+        for keyword in found:
+            excluded.update(self._exclude.get(keyword, EMPTY))
+            included.update(self._include.get(keyword, EMPTY))
+        includers = self._includers
+        return [channel_id for channel_id in channels
+                if channel_id not in excluded and (channel_id in included or channel_id not in includers)]
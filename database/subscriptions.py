@@ -0,0 +1,58 @@
+import threading
+
+EMPTY = frozenset()
+
+
+class SubscriptionIndex:
+    """ In-memory copy of 'channel_categories' in both directions (category -> chats, chat -> categories).
+        Sets are immutable and replaced on every write, so the publisher reads them without locking
+        while the command handlers update them (write-through, after the database commit) """
+    __slots__ = ["_by_category", "_by_channel", "_lock"]
+
+    def __init__(self, rows=()):
+        self._by_category = {}  # category_id: frozenset of channel_id
+        self._by_channel = {}  # channel_id: frozenset of category_id
+        self._lock = threading.Lock()
+        self.load(rows)
+
+    def load(self, rows) -> None:
+        """ Rebuild the index from '(channel_id, category_id)' rows """
+        by_category, by_channel = {}, {}
+        for channel_id, category_id in rows:
+            by_category.setdefault(category_id, set()).add(channel_id)
+            by_channel.setdefault(channel_id, set()).add(category_id)
+        with self._lock:
+            self._by_category = {k: frozenset(v) for k, v in by_category.items()}
+            self._by_channel = {k: frozenset(v) for k, v in by_channel.items()}
+
+    def channels(self, category_id: int) -> frozenset:
+        """ Chats that enabled the category """
+        return self._by_category.get(category_id, EMPTY)
+
+    def categories(self, channel_id: int) -> frozenset:
+        """ Categories enabled in the chat """
+        return self._by_channel.get(channel_id, EMPTY)
+
+    def add(self, channel_id: int, category_ids) -> None:
+        with self._lock:
+            for category_id in category_ids:
+                self._by_category[category_id] = self._by_category.get(category_id, EMPTY) | {channel_id}
+            self._by_channel[channel_id] = self._by_channel.get(channel_id, EMPTY) | set(category_ids)
+
+    def remove(self, channel_id: int, category_ids) -> None:
+        with self._lock:
+            for category_id in category_ids:
+                channels = self._by_category.get(category_id, EMPTY) - {channel_id}
+                if channels:
+                    self._by_category[category_id] = channels
+                else:
+                    self._by_category.pop(category_id, None)
+            categories = self._by_channel.get(channel_id, EMPTY) - set(category_ids)
+            if categories:
+                self._by_channel[channel_id] = categories
+            else:
+                self._by_channel.pop(channel_id, None)
+
+    def remove_channel(self, channel_id: int) -> None:
+        """ Forget every subscription of the chat """
+        self.remove(channel_id, self.categories(channel_id))
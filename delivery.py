@@ -0,0 +1,261 @@
+from metrics import timed, SEND_SECONDS, SEND_ERRORS, RETRY_AFTER_SECONDS, OUTBOX_DEPTH, SCHEDULER_DEPTH
+from concurrent.futures import ThreadPoolExecutor
+from telegram.utils.request import Request
+from ratelimit import DeliveryScheduler
+from articles import NewsMessage, render_digest
+from photos import PhotoIdCache
+from dotenv import load_dotenv
+from database import Database
+from functools import partial
+import telegram.error
+import argparse
+import metrics
+import telegram
+import asyncio
+import logging
+import sqlite3
+import socket
+import json
+import os
+
+
+def news_payload(news: NewsMessage) -> str:
+    """ Serialize a rendered news for the outbox """
+    return json.dumps(news, ensure_ascii=False)
+
+
+def news_from_payload(payload: str) -> NewsMessage:
+    return NewsMessage._make(json.loads(payload))
+
+
+class TelegramSender:
+    """ Send rendered news through the blocking python-telegram-bot client without blocking the event loop """
+    __slots__ = ["bot", "db", "send_pool", "photo_ids"]
+
+    def __init__(self, bot: telegram.Bot, db: Database, send_workers: int = 32):
+        self.bot = bot
+        self.db = db
+        # python-telegram-bot calls are blocking, they run here so the event loop keeps serving other chats
+        self.send_pool = ThreadPoolExecutor(max_workers=send_workers, thread_name_prefix="send")
+        self.photo_ids = PhotoIdCache(db)
+
+    @timed(SEND_SECONDS)
+    async def send(self, channel_id: int, news: NewsMessage) -> bool:
+        """ Send the news as a photo with caption, as many async tasks in the same time,
+            the photo is replaced by the text-only form if telegram refuses it. Return whether the news was sent """
+        countdown: int = 2048
+        img = news.img
+        while countdown:
+            photo, is_upload = await self.photo_ids.reference(img)
+            message = None
+            try:
+                message = await self._call_bot_api(self.bot.send_photo, chat_id=channel_id, photo=photo,
+                                                   caption=news.caption, parse_mode='markdown')
+                return True
+            except telegram.error.Unauthorized as e:
+                SEND_ERRORS.inc(error=type(e).__name__)
+                self.db.remove_chat(channel_id)
+                break
+            except telegram.error.TimedOut as e:
+                SEND_ERRORS.inc(error=type(e).__name__)
+                print(f'{e} (NOT RAISED) occurred trying to send photo update, retrying to send the news...\n'
+                      f' countdown {countdown}')
+                countdown >>= 1
+                await asyncio.sleep(3)
+            except telegram.error.BadRequest as e:
+                SEND_ERRORS.inc(error=type(e).__name__)
+                if photo != img:  # stale file_id, upload the url again
+                    self.photo_ids.forget(img)
+                    continue
+                print(f'{e.args}: photo refused, sending the text-only news\n'
+                      f'channel id: {channel_id}\n'
+                      f'image: {img}\n'
+                      f'link: {news.link}')
+                return await self._send_text(channel_id, news)
+            except telegram.error.RetryAfter as e:
+                SEND_ERRORS.inc(error=type(e).__name__)
+                RETRY_AFTER_SECONDS.inc(e.retry_after)
+                print(f'{e.args} occurred trying to send photo update, the scheduler will retry after {e.retry_after}s')
+                raise
+            finally:
+                if is_upload:
+                    self.photo_ids.uploaded(img, message)
+        return False
+
+    async def _send_text(self, channel_id: int, news: NewsMessage) -> bool:
+        """ Fallback of 'send' without the photo, a news telegram can't parse is dropped
+            instead of aborting the whole update round """
+        try:
+            await self._call_bot_api(self.bot.send_message, chat_id=channel_id, text=news.text,
+                                     parse_mode='markdown')
+            return True
+        except telegram.error.BadRequest as e:
+            SEND_ERRORS.inc(error=type(e).__name__)
+            print(f'{e.args}: text-only news refused too, dropping it\n'
+                  f'channel id: {channel_id}\n'
+                  f'link: {news.link}')
+            return False
+
+    @timed(SEND_SECONDS)
+    async def send_digest(self, channel_id: int, text: str) -> bool:
+        """ Send a digest rendered by 'render_digest' as a single text message without link previews """
+        try:
+            await self._call_bot_api(self.bot.send_message, chat_id=channel_id, text=text, parse_mode='markdown',
+                                     disable_web_page_preview=True)
+            return True
+        except telegram.error.Unauthorized as e:
+            SEND_ERRORS.inc(error=type(e).__name__)
+            self.db.remove_chat(channel_id)
+            return False
+        except telegram.error.BadRequest as e:
+            SEND_ERRORS.inc(error=type(e).__name__)
+            print(f'{e.args}: digest refused, dropping it\n'
+                  f'channel id: {channel_id}')
+            return False
+        except telegram.error.RetryAfter as e:
+            SEND_ERRORS.inc(error=type(e).__name__)
+            RETRY_AFTER_SECONDS.inc(e.retry_after)
+            raise
+
+    async def _call_bot_api(self, method, **kwargs):
+        """ Run a blocking Bot API method in 'send_pool' without blocking the event loop """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.send_pool, partial(method, **kwargs))
+
+    def close(self) -> None:
+        self.send_pool.shutdown(wait=False)
+
+
+class OutboxWorker:
+    """ Drain the outbox messages of one shard of chats (channel_id % shards == shard).
+        Messages are leased while they are being sent and the leases are renewed by a heartbeat,
+        if the worker dies its leases expire and the shard is taken over by the next worker started """
+    __slots__ = ["db", "sender", "scheduler", "shard", "shards", "owner", "batch_size", "lease", "idle_sleep",
+                 "max_attempts", "inflight"]
+
+    def __init__(self, db: Database, sender: TelegramSender, scheduler: DeliveryScheduler = None,
+                 shard: int = 0, shards: int = 1, batch_size: int = 500, lease: int = 120,
+                 idle_sleep: float = 1.0, max_attempts: int = 5):
+        self.db = db
+        self.sender = sender
+        self.scheduler = scheduler or DeliveryScheduler()
+        self.shard = shard
+        self.shards = shards
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{shard}/{shards}'
+        self.batch_size = batch_size
+        self.lease = lease
+        self.idle_sleep = idle_sleep
+        self.max_attempts = max_attempts
+        self.inflight = set()  # outbox_id of the messages handed to the scheduler
+        OUTBOX_DEPTH.set_function(lambda: self.db.outbox_depth(shard, shards), shard=shard)
+        SCHEDULER_DEPTH.set_function(self.scheduler.queue_depth, shard=shard)
+
+    async def run(self) -> None:
+        """ Claim and send messages forever, an error (e.g. the database busy beyond its timeout)
+            only costs the current claim: the messages stay queued for the next one """
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while True:
+                try:
+                    claimed = await self.drain_once()
+                except Exception:
+                    logging.exception(f'Unexpected error draining the outbox of shard {self.shard}, retrying')
+                    claimed = 0
+                if not claimed:
+                    await asyncio.sleep(self.idle_sleep)
+        finally:
+            heartbeat.cancel()
+
+    async def drain_once(self) -> int:
+        """ Claim as many messages as the free in-flight slots and queue them in the scheduler,
+            the news claimed for a chat in digest mode are sent together. Return how many were claimed """
+        free = self.batch_size - len(self.inflight)
+        if free <= 0:
+            return 0
+        rows = self.db.claim_outbox(self.owner, self.shard, self.shards, free, self.lease)
+        digests = {}  # channel_id: list of the claimed rows
+        for outbox_id, channel_id, news_hash, attempts, payload, digest_interval in rows:
+            self.inflight.add(outbox_id)
+            if digest_interval:
+                digests.setdefault(channel_id, []).append((outbox_id, news_hash, attempts, payload))
+                continue
+            self._submit(channel_id, [(outbox_id, news_hash, attempts)],
+                         partial(self.sender.send, channel_id, news_from_payload(payload)))
+        for channel_id, digest_rows in digests.items():
+            if len(digest_rows) == 1:  # nothing to collapse
+                outbox_id, news_hash, attempts, payload = digest_rows[0]
+                self._submit(channel_id, [(outbox_id, news_hash, attempts)],
+                             partial(self.sender.send, channel_id, news_from_payload(payload)))
+                continue
+            by_hash = {news_hash: (outbox_id, news_hash, attempts) for outbox_id, news_hash, attempts, _ in digest_rows}
+            for text, news_list in render_digest([news_from_payload(row[3]) for row in digest_rows]):
+                self._submit(channel_id, [by_hash[news.news_hash] for news in news_list],
+                             partial(self.sender.send_digest, channel_id, text))
+        return len(rows)
+
+    def _submit(self, channel_id: int, messages: list, send) -> None:
+        """ Queue one telegram message carrying the outbox messages '(outbox_id, news_hash, attempts)' """
+        future = self.scheduler.submit(channel_id, send, messages[0][0])
+        future.add_done_callback(partial(self._done, channel_id, messages))
+
+    def _done(self, channel_id: int, messages: list, future: asyncio.Future) -> None:
+        self.inflight.difference_update(outbox_id for outbox_id, _, _ in messages)
+        if future.cancelled():
+            return  # shutting down, the lease expires and the message is sent by the next worker
+        error = future.exception()
+        if error is None:
+            for outbox_id, news_hash, _ in messages:
+                self.db.complete_outbox(outbox_id, channel_id, news_hash, future.result() is True)
+            return
+        SEND_ERRORS.inc(error=type(error).__name__)
+        for outbox_id, news_hash, attempts in messages:
+            if attempts + 1 >= self.max_attempts:
+                logging.warning(f'{error!r} sending {news_hash} to {channel_id}, dropped after {attempts + 1} attempts')
+                self.db.complete_outbox(outbox_id, channel_id, news_hash, False)
+            else:
+                logging.warning(f'{error!r} sending {news_hash} to {channel_id}, retrying later')
+                self.db.release_outbox(outbox_id, 30 * 2 ** attempts)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if self.inflight:
+                try:
+                    self.db.renew_leases(self.owner, self.lease)
+                except sqlite3.Error as e:  # the next beat comes well before the leases expire
+                    logging.warning(f'{e!r} renewing the leases of {self.owner}')
+
+
+def main() -> None:
+    """ Entry point of a standalone delivery worker: python delivery.py --shard 0 --shards 4,
+        on the host of the publisher: the database is in WAL mode, whose shared memory index
+        doesn't work across hosts or on network filesystems """
+    arg_parser = argparse.ArgumentParser(description="Deliver the queued news of one shard of chats")
+    arg_parser.add_argument("--shard", type=int, default=0, help="index of the shard drained by this worker")
+    arg_parser.add_argument("--shards", type=int, default=1, help="number of workers sharing the outbox")
+    arg_parser.add_argument("--db", default="bot.db", help="bot database shared with the publisher (local file)")
+    arg_parser.add_argument("--send-workers", type=int, default=32, help="threads sending to telegram")
+    arg_parser.add_argument("--global-rate", type=float, default=30,
+                            help="messages per second telegram allows the whole bot, split evenly between the shards")
+    arg_parser.add_argument("--metrics-port", type=int, default=0, help="serve /metrics on this port (0 = off)")
+    args = arg_parser.parse_args()
+    if not 0 <= args.shard < args.shards:
+        arg_parser.error("--shard must be between 0 and --shards - 1")
+    load_dotenv()
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    bot = telegram.Bot(os.getenv("TOKEN"), request=Request(con_pool_size=args.send_workers + 4))
+    db = Database(args.db)
+    sender = TelegramSender(bot, db, args.send_workers)
+    # every worker has its own buckets: together they must stay within the limit of the bot
+    scheduler = DeliveryScheduler(global_rate=args.global_rate / args.shards)
+    worker = OutboxWorker(db, sender, scheduler, shard=args.shard, shards=args.shards)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        sender.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
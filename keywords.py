@@ -0,0 +1,78 @@
+from collections import deque
+import unicodedata
+
+
+# italian words found in almost every article: searching them only costs time (see 'Database.search_archive')
+STOPWORDS = frozenset("""
+a ad al alla alle agli ai all anche che chi ci con da dal dalla dalle dagli dai degli dei del della delle di
+e ed gli ha hanno i il in l la le lo ma ne nel nella nelle negli nei non o per piu se si sono su sul sulla
+tra fra un una uno stato stata sua suo sue suoi loro come dopo
+""".split())
+
+
+def normalize(text: str) -> str:
+    """ Case and accent insensitive form of a text ('Città' -> 'citta'), one character per character
+        of the result so match positions can be checked against word boundaries """
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+class KeywordMatcher:
+    """ Aho-Corasick automaton over a set of keywords: 'find' scans a text once, whatever the number
+        of keywords, and returns the keywords found as whole words """
+    __slots__ = ["keywords", "_goto", "_fail", "_out"]
+
+    def __init__(self, keywords=()):
+        self.keywords = frozenset(normalize(k) for k in keywords if k.strip())
+        self._goto = [{}]  # state: {character: next state}, state 0 is the root
+        self._fail = [0]  # state: longest proper suffix state
+        self._out = [()]  # state: keywords ending in the state
+        for keyword in self.keywords:
+            self._insert(keyword)
+        self._link()
+
+    def _insert(self, keyword: str) -> None:
+        state = 0
+        for char in keyword:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = nxt
+        self._out[state] = self._out[state] + (keyword,)
+
+    def _link(self) -> None:
+        """ Failure links, breadth first so the suffix states are always linked before """
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                candidate = self._goto[fail].get(char, 0)
+                self._fail[nxt] = candidate if candidate != nxt else 0  # a root child fails to the root
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def find(self, text: str) -> set:
+        """ Keywords (normalized) found in the text as whole words """
+        found = set()
+        if not self.keywords:
+            return found
+        text = normalize(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword in out[state]:
+                start = end - len(keyword) + 1
+                if (start == 0 or not text[start - 1].isalnum()) and \
+                        (end + 1 == len(text) or not text[end + 1].isalnum()):
+                    found.add(keyword)
+        return found
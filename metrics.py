@@ -0,0 +1,204 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from functools import wraps
+import threading
+import inspect
+import logging
+import bisect
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labels_text(labelnames: tuple, values: tuple) -> str:
+    if not labelnames:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(labelnames, values))
+    return f'{{{pairs}}}'
+
+
+class Metric:
+    """ Base of the Prometheus-style metrics: a value for every combination of label values,
+        rendered in the text exposition format served on '/metrics' """
+    __slots__ = ["name", "help", "labelnames", "_values", "_lock"]
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values tuple: value
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        """ Yield '(name suffix, label values, value)' of every series """
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield '', key, value() if callable(value) else value
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, value in self.samples():
+            labelnames = self.labelnames + (('le',) if len(key) > len(self.labelnames) else ())
+            lines.append(f'{self.name}{suffix}{_labels_text(labelnames, key)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    __slots__ = []
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    __slots__ = []
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function, **labels) -> None:
+        """ Read the value from function() at every scrape """
+        with self._lock:
+            self._values[self._key(labels)] = function
+
+
+class Histogram(Metric):
+    __slots__ = ["buckets"]
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # counts, sum, count
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """ Context manager observing the seconds spent in the block """
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield '_bucket', key + (bound,), cumulative
+            yield '_sum', key, total
+            yield '_count', key, count
+
+
+class _Timer:
+    __slots__ = ["histogram", "labels", "start"]
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def timed(histogram: Histogram, **labels):
+    """ Decorator observing the duration of every call of a function or coroutine function """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await function(*args, **kwargs)
+        else:
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+REGISTRY = []  # every metric created, in creation order
+
+
+def render() -> str:
+    """ Prometheus text exposition of every metric """
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> HTTPServer:
+    """ Serve '/metrics' from a single daemon thread: some gauges query the database, whose
+        connections are per thread and kept until 'Database.close', a thread per scrape would leak one each """
+    server = HTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+
+def start_log_dump(interval: float, logger: logging.Logger = None) -> threading.Thread:
+    """ Log the whole exposition every 'interval' seconds from a daemon thread """
+    logger = logger or logging.getLogger('METRICS')
+
+    def dump():
+        while True:
+            time.sleep(interval)
+            logger.info('\n' + render())
+    thread = threading.Thread(target=dump, name='metrics-log', daemon=True)
+    thread.start()
+    return thread
+
+
+# pipeline metrics, shared by the modules that record them
+FEED_FETCH_SECONDS = Histogram('ansa_feed_fetch_seconds', 'Duration of the conditional GET of a feed', ('category',))
+FEED_BYTES = Counter('ansa_feed_bytes_total', 'Bytes of feed bodies downloaded', ('category',))
+FEED_RESPONSES = Counter('ansa_feed_responses_total', 'Feed responses by status (304 = unchanged)', ('status',))
+FEED_HEDGES = Counter('ansa_feed_hedged_total', 'Second requests sent for hot feeds slow to answer')
+FEEDS_FAILING = Gauge('ansa_feeds_circuit_open', 'Feeds whose polls failed often enough to open their circuit')
+PARSE_FEED_SECONDS = Histogram('ansa_parse_feed_seconds', 'Duration of a whole polling round (RssParser.parse_feed)')
+FEED_PARSE_SECONDS = Histogram('ansa_feed_parse_seconds', 'Duration of the rss parsing of a feed body', ('category',))
+ARTICLE_FETCH_SECONDS = Histogram('ansa_article_fetch_seconds', 'Duration of an article page GET')
+ARTICLE_BYTES = Counter('ansa_article_bytes_total', 'Bytes of article pages read (up to the end of their head)')
+LINK_METAS_SECONDS = Histogram('ansa_link_metas_seconds', 'Duration of RssParser.parse_link_metas (cache hits included)')
+CACHE_HIT_RATIO = Gauge('ansa_cache_hit_ratio', 'Hit ratio of the in-process caches', ('cache',))
+OUTBOX_DEPTH = Gauge('ansa_outbox_depth', 'Messages queued in the outbox for the shard', ('shard',))
+SCHEDULER_DEPTH = Gauge('ansa_scheduler_queue_depth', 'Messages waiting in the rate limited chat queues', ('shard',))
+SEND_SECONDS = Histogram('ansa_telegram_send_seconds', 'Duration of the delivery of a news (retries included)')
+SEND_ERRORS = Counter('ansa_telegram_errors_total', 'Telegram errors while sending, by class', ('error',))
+RETRY_AFTER_SECONDS = Counter('ansa_telegram_retry_after_seconds_total', 'Seconds of RetryAfter asked by telegram')
+DB_QUERY_SECONDS = Histogram('ansa_db_query_seconds', 'Duration of Database.exec by statement', ('statement',),
+                             buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
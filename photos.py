@@ -0,0 +1,54 @@
+from metrics import CACHE_HIT_RATIO
+from database import Database
+from cache import LruCache
+import asyncio
+
+
+class PhotoIdCache:
+    """ Map article image urls to the telegram 'file_id' of the first successful upload,
+        so telegram downloads every ANSA image only once instead of once per chat """
+    __slots__ = ["db", "memory", "uploads"]
+
+    def __init__(self, db: Database, maxsize: int = 10000):
+        self.db = db
+        self.memory = LruCache(maxsize)  # img url: file_id
+        self.uploads = {}  # img url: asyncio.Future resolved with the file_id once the first upload ends
+        CACHE_HIT_RATIO.set_function(lambda: self.memory.stats()["hit_ratio"], cache="photos")
+
+    async def reference(self, img: str) -> tuple:
+        """ Return '(photo, is_upload)': the known file_id of img, or img itself when it has to be uploaded.
+            While the first upload of img is running, other chats wait for its file_id
+            instead of making telegram fetch the same url again """
+        file_id = self._lookup(img)
+        if file_id:
+            return file_id, False
+        pending = self.uploads.get(img)
+        if pending is not None:
+            file_id = await asyncio.shield(pending)
+            return (file_id, False) if file_id else (img, False)
+        self.uploads[img] = asyncio.get_running_loop().create_future()
+        return img, True
+
+    def _lookup(self, img: str):
+        file_id = self.memory.get(img)
+        if file_id is None:
+            file_id = self.db.get_photo_file_id(img)
+            if file_id:
+                self.memory.put(img, file_id)
+        return file_id
+
+    def uploaded(self, img: str, message) -> None:
+        """ End the upload of img started by 'reference', message is the sent telegram.Message
+            (None if the upload failed) """
+        file_id = message.photo[-1].file_id if message is not None and message.photo else None
+        if file_id:
+            self.memory.put(img, file_id)
+            self.db.put_photo_file_id(img, file_id)
+        pending = self.uploads.pop(img, None)
+        if pending is not None and not pending.done():
+            pending.set_result(file_id)
+
+    def forget(self, img: str) -> None:
+        """ Drop a file_id refused by telegram, the next send uploads the url again """
+        self.memory.pop(img)
+        self.db.delete_photo_file_id(img)
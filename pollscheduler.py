@@ -0,0 +1,39 @@
+import random
+
+
+class PollScheduler:
+    """ Per feed polling interval adapted to how often the feed publishes:
+        a feed that had news is polled about once per expected new item,
+        a feed without news backs off, always within [min_interval, max_interval] seconds
+        and with some jitter so the feeds don't end up polled all in the same tick.
+        A feed whose poll fails is retried with an exponential backoff and, after 'failure_threshold'
+        failures in a row, its circuit opens: it is tried again only once every 'open_interval' seconds """
+    __slots__ = ["min_interval", "max_interval", "backoff", "jitter", "failure_threshold", "open_interval"]
+
+    def __init__(self, min_interval: int = 60, max_interval: int = 1800, backoff: float = 1.5, jitter: float = 0.1,
+                 failure_threshold: int = 5, open_interval: int = 3600):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.failure_threshold = failure_threshold
+        self.open_interval = open_interval
+
+    def next_interval(self, interval: int, new_items: int, elapsed: int) -> int:
+        """ New polling interval of a feed that published new_items in the last 'elapsed' seconds """
+        if new_items:
+            # average time between two items, smoothed with the previous interval
+            target = (interval + elapsed / new_items) / 2
+        else:
+            target = interval * self.backoff
+        return int(min(self.max_interval, max(self.min_interval, target)))
+
+    def next_poll(self, now: int, interval: int) -> int:
+        """ Epoch of the next poll, 'interval' seconds from now give or take the jitter """
+        return now + int(interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def retry_interval(self, failures: int) -> int:
+        """ Seconds before polling again a feed that failed 'failures' times in a row """
+        if failures >= self.failure_threshold:  # circuit open, a single trial poll every open_interval
+            return self.open_interval
+        return min(self.max_interval, self.min_interval * 2 ** (failures - 1))
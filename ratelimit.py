@@ -0,0 +1,114 @@
+import telegram.error
+import itertools
+import asyncio
+import logging
+import time
+
+
+class TokenBucket:
+    """ Classic token bucket: 'rate' tokens per second are added up to 'capacity',
+        every message takes one token and waits for it when the bucket is empty """
+    __slots__ = ["rate", "capacity", "tokens", "updated", "blocked_until"]
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # set by 'block' when telegram answers RetryAfter
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        """ Wait until a token is available and take it """
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def restart(self) -> None:
+        """ Count the next token from now: the spacing telegram checks is between the requests
+            it receives, not between the tokens taken before waiting for the rest of the send """
+        self.updated = time.monotonic()
+
+    def block(self, seconds: float) -> None:
+        """ Refuse every token for the next 'seconds' and restart from an empty bucket """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+class DeliveryScheduler:
+    """ Fan-out of telegram messages at the maximum rate allowed by the Bot API:
+        a global bucket for the whole bot and a bucket per chat (private chats and groups
+        have different limits), every chat drains its own priority queue in a lazily spawned task
+        and 'RetryAfter' answers pause the chat for the requested time and retry the message """
+    __slots__ = ["global_bucket", "private_rate", "group_rate", "buckets", "queues", "workers", "_seq"]
+
+    def __init__(self, global_rate: float = 30, private_rate: float = 1, group_rate: float = 20 / 60):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.buckets = {}  # chat_id: TokenBucket
+        self.queues = {}  # chat_id: asyncio.PriorityQueue of (priority, seq, send, future)
+        self.workers = {}  # chat_id: asyncio.Task draining the chat queue
+        self._seq = itertools.count()  # keeps FIFO order between messages with the same priority
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # negative ids are groups, supergroups and channels
+            bucket = TokenBucket(self.group_rate if chat_id < 0 else self.private_rate)
+            self.buckets[chat_id] = bucket
+        return bucket
+
+    def submit(self, chat_id: int, send, priority: int = 0) -> asyncio.Future:
+        """ Queue 'send' (a coroutine function without arguments) for the chat,
+            lower priorities are sent first, the returned future gets the result of 'send' """
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.PriorityQueue()
+        queue.put_nowait((priority, next(self._seq), send, future))
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._drain(chat_id, queue))
+        return future
+
+    def queue_depth(self) -> int:
+        """ Messages waiting to be sent in every chat """
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    async def _drain(self, chat_id: int, queue: asyncio.PriorityQueue) -> None:
+        bucket = self._bucket(chat_id)
+        try:
+            while not queue.empty():
+                priority, seq, send, future = queue.get_nowait()
+                if future.cancelled():
+                    continue
+                # the chat token last, right before the request leaves, and restarted once it is answered
+                await self.global_bucket.acquire()
+                await bucket.acquire()
+                try:
+                    result = await send()
+                except telegram.error.RetryAfter as e:
+                    logging.warning(f'RetryAfter {e.retry_after}s for chat {chat_id}, message requeued')
+                    bucket.block(e.retry_after)
+                    queue.put_nowait((priority, seq, send, future))
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+                finally:
+                    bucket.restart()
+        finally:
+            del self.workers[chat_id]
+            del self.queues[chat_id]
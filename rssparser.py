@@ -1,134 +1,492 @@
+from metrics import (timed, FEED_FETCH_SECONDS, FEED_BYTES, FEED_RESPONSES, PARSE_FEED_SECONDS, FEED_PARSE_SECONDS,
+                     ARTICLE_FETCH_SECONDS, ARTICLE_BYTES, LINK_METAS_SECONDS, CACHE_HIT_RATIO, FEED_HEDGES,
+                     FEEDS_FAILING)
+from pollscheduler import PollScheduler
+from articles import canonical_link, render_news, NewsMessage
 from database import Database
-from lxml import etree, html
-from io import StringIO
+from cache import LruCache
+from datetime import datetime
+from functools import lru_cache
+from lxml import etree
+from io import BytesIO
 import asyncio
 import logging
 import httpx
 import time
-import sys
+
+
+def iter_rss_items(rss_content: bytes):
+    """ Lazily yield '(title, link, pubDate)' texts of every <item> of a rss document,
+        each item is freed as soon as it has been read so memory does not grow with the feed """
+    for _, item in etree.iterparse(BytesIO(rss_content), events=("end",), tag="item"):
+        yield item.findtext("title"), item.findtext("link"), item.findtext("pubDate")
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
+
+
+HEAD_METAS = {'EdTitle', 'description', 'twitter:image:src', 'og:image'}  # meta name (or property) read
+
+
+def read_head_metas(parser: etree.HTMLPullParser, metas: dict) -> bool:
+    """ Copy the content of the HEAD_METAS parsed so far into metas (the first of every name wins),
+        return True once the head is over """
+    for event, element in parser.read_events():
+        if event == "start" and element.tag == "meta":
+            key = element.get("name") or element.get("property")
+            if key in HEAD_METAS and key not in metas:
+                metas[key] = element.get("content", "")
+        elif (event == "end" and element.tag == "head") or (event == "start" and element.tag == "body"):
+            return True
+    return False
+
+
+@lru_cache(maxsize=8192)
+def pubdate_to_epoch(pubdate: str) -> int:
+    """ Epoch of a rss pubDate ('Mon, 02 Jan 2023 10:00:00 +0100' or '02 Jan 2023 10:00:00 +0100'),
+        cached since the same items are read again at every poll and from several feeds """
+    try:
+        return int(datetime.strptime(pubdate.strip(), "%a, %d %b %Y %H:%M:%S %z").timestamp())
+    except ValueError:
+        return int(datetime.strptime(pubdate.strip(), "%d %b %Y %H:%M:%S %z").timestamp())
+
+
+class FeedPoll:
+    """ State of a feed during a polling round of 'RssParser.parse_feed' """
+    __slots__ = ["catid", "name", "feed", "db_epoch", "etag", "last_modified", "poll_interval", "last_polled",
+                 "failures", "resp", "error", "new_epochs", "failed", "pending", "parsed", "news_count"]
+
+    def __init__(self, catid: int, name: str, feed: str, db_epoch: int, etag: str, last_modified: str,
+                 poll_interval: int, last_polled: int, failures: int):
+        self.catid = catid
+        self.name = name
+        self.feed = feed
+        self.db_epoch = db_epoch
+        self.etag = etag
+        self.last_modified = last_modified
+        self.poll_interval = poll_interval
+        self.last_polled = last_polled
+        self.failures = failures  # polls failed in a row before this one
+        self.resp = None  # response of the conditional GET
+        self.error = None  # why the feed could not be fetched or parsed this time
+        self.new_epochs = []  # publication dates of the items newer than db_epoch
+        self.failed = []  # publication dates of the items that could not be scraped
+        self.pending = 0  # items queued and not scraped yet
+        self.parsed = False  # every new item has been queued
+        self.news_count = 0  # news published
 
 
 class RssParser:
-    __slots__ = ["urls", "bot_db", "ansa_url"]
+    __slots__ = ["bot_db", "client", "fetch_sem", "host_sems", "max_per_host", "fetch_timeout", "retries",
+                 "meta_cache", "meta_ttl", "persist_metas", "inflight", "poll_scheduler", "scrapers", "queue_size",
+                 "feed_timeout", "hedge_after", "give_up_after"]
 
-    def __init__(self, db: Database, urls: list):
-        self.urls = urls
+    def __init__(self, db: Database, max_concurrency: int = 20, max_per_host: int = 8,
+                 fetch_timeout: float = 10.0, retries: int = 2,
+                 meta_cache_size: int = 4096, meta_ttl: int = 6 * 3600, persist_metas: bool = False,
+                 poll_scheduler: PollScheduler = None, queue_size: int = 64,
+                 feed_timeout: float = 15.0, hedge_after: float = None, give_up_after: int = 6 * 3600):
+        """ max_concurrency = article pages fetched at the same time (all hosts together)
+            max_per_host = article pages fetched at the same time from a single host
+            fetch_timeout = seconds allowed to every single article request, retries included each
+            feed_timeout = seconds allowed to the whole download of a feed
+            hedge_after = seconds after which a second request is sent for a hot feed that did not answer yet
+                (the fastest answer wins), None never hedges
+            retries = how many times a failed article request is repeated before giving up
+            give_up_after = seconds after its publication an article that still can't be scraped is skipped,
+                the feed epoch moves past it (articles answering 4xx are skipped at once)
+            meta_cache_size, meta_ttl = bounds of the in-process article metadata cache
+            persist_metas = also keep the article metadata in the database 'article_metas' table
+            poll_scheduler = decides when every feed is polled again (default PollScheduler())
+            queue_size = items waiting between two stages of 'parse_feed' before the previous stage waits
+        """
         self.bot_db = db
+        # long-lived pooled client, connections (and TLS sessions) are reused across polling rounds
+        self.client = httpx.AsyncClient(limits=httpx.Limits(max_connections=50, max_keepalive_connections=50),
+                                        timeout=httpx.Timeout(feed_timeout))
+        self.fetch_sem = asyncio.Semaphore(max_concurrency)
+        self.host_sems = {}  # host: asyncio.Semaphore(max_per_host)
+        self.max_per_host = max_per_host
+        self.fetch_timeout = fetch_timeout
+        self.retries = retries
+        self.meta_cache = LruCache(meta_cache_size, meta_ttl)  # canonical link: NewsMessage
+        self.meta_ttl = meta_ttl
+        self.persist_metas = persist_metas
+        self.inflight = {}  # canonical link: asyncio.Task scraping it right now
+        self.poll_scheduler = poll_scheduler or PollScheduler()
+        self.scrapers = max_concurrency  # workers of the scraping stage of 'parse_feed'
+        self.queue_size = queue_size
+        self.feed_timeout = feed_timeout
+        self.hedge_after = hedge_after
+        self.give_up_after = give_up_after
+        CACHE_HIT_RATIO.set_function(lambda: self.meta_cache.stats()["hit_ratio"], cache="articles")
+        FEEDS_FAILING.set_function(lambda: self.bot_db.failing_feeds(self.poll_scheduler.failure_threshold))
         logging.basicConfig(filename="rssparser.log", level=logging.INFO)
 
-    async def get_db_args(self) -> list:
-        """ Fetch database table 'categories' into a list of tuples '(category_id: int, category_name: str, last publication link: str)' """
+    async def get_db_args(self, now: int) -> list:
+        """ Fetch the feeds of database table 'categories' due to be polled at 'now' into a list of tuples
+            '(category_id: int, category_name: str, feed: str, epoch: int, etag: str, last_modified: str,
+              poll_interval: int, last_polled: int, failures: int)' """
         # print("sono in get_db_args") for debugging purpose
-        self.bot_db.exec("SELECT category_id, name, epoch FROM categories")
-        catid_name_epoch_db = [x for x in self.bot_db.cursor.fetchall()]
-        return catid_name_epoch_db
-
-    async def parse_feed(self) -> dict:
-        """ Setup environment variables to feed 'get_news_from_html' with
-            rss_pages = list of rss pages
-            catid_name_epoch_db = list of tuples from database '(category_id: int, category_name: str, last publish date: str)'
-            new_feeds = dictionary to pair chat group id with the actual news '(chat_id: news)'
+        self.bot_db.exec("SELECT category_id, name, feed, epoch, etag, last_modified, poll_interval, last_polled, "
+                         "failures FROM categories WHERE active = 1 AND next_poll <= ?", [now])
+        catid_name_feed_epoch_db = [x for x in self.bot_db.cursor.fetchall()]
+        return catid_name_feed_epoch_db
+
+    @timed(PARSE_FEED_SECONDS)
+    async def parse_feed(self, publish=None) -> int:
+        """ Poll the feeds due now (see 'get_db_args') through a pipeline of stages connected by
+            bounded queues: feed fetch -> item parse -> article scraping -> publish, so the first news
+            are published while the later ones are still scraped and a burst never sits in memory whole.
+            Feeds unchanged since the last poll answer 304 and are not parsed at all, a feed that can't be
+            fetched within 'feed_timeout' or parsed only skips itself and is retried later (see 'reschedule').
+            publish(new_feeds) is called (synchronously, new_feeds = '{category_id: [name, news...]}' with the
+            most recent news first) with every batch of news scraped; once every item of a feed is handled
+            its epoch is moved forward in the same transaction as its last news, so a crash never loses news
+            that were parsed but not queued. Return how many news were published
         """
-        new_feeds = {}  # will contain 'category_id : category_news'
-        async with httpx.AsyncClient() as client:  # async client for http requests
-            tasks = (client.get(url, timeout=None)
-                     for url in self.urls)
-            reqs = await asyncio.gather(*tasks)
-        parser = etree.XMLParser()
-        rss_pages = [etree.parse(StringIO(req.text), parser) for req in reqs]
-        catid_name_epoch_db = await self.get_db_args()
-        get_news = (self.get_news_from_html(new_feeds, catid, name, db_epoch, rss_xml)
-                    for (catid, name, db_epoch), rss_xml
-                    in zip(catid_name_epoch_db, rss_pages))
-        await asyncio.gather(*get_news)
-        return new_feeds
-
-    async def get_news_from_html(self, new_feeds: dict, catid: int, name: str, db_epoch: int,
-                                 rss_xml: etree._ElementTree) -> None:
-        """ The actual fetching function that parse, check, format and add news to 'new_feeds' """
+        if self.persist_metas:
+            self.bot_db.prune_article_metas(self.meta_ttl)
+        now = int(time.time())
+        polls = [FeedPoll(*row) for row in await self.get_db_args(now)]
+        if not polls:
+            return 0
+        feeds_queue = asyncio.Queue(self.queue_size)  # FeedPoll with its response, None at the end
+        items_queue = asyncio.Queue(self.queue_size)  # (FeedPoll, link, item epoch), None at the end
+        news_queue = asyncio.Queue(self.queue_size)  # (FeedPoll, item epoch, NewsMessage or None), None at the end
+        stages = [asyncio.create_task(self._fetch_stage(polls, feeds_queue)),
+                  asyncio.create_task(self._parse_stage(feeds_queue, items_queue, news_queue)),
+                  asyncio.create_task(self._scrape_stage(items_queue, news_queue)),
+                  asyncio.create_task(self._publish_stage(news_queue, publish, now))]
         try:
-            items = rss_xml.xpath("//item")
-        except etree.Error as e:
-            logging.warning(f'{e} occurred at {time.strftime("%d.%m.%y %I:%M:%S", time.localtime(int(time.time())))}\n'
-                            f'printing xml that could have caused the issue\n'
-                            f'{rss_xml}\n')
-            return
-        if not items:
-            return
-        rss_new_items = []
-        rss_new_items.append(f'{name}')
-        epochs_pool = 0
-        for item in items:
+            results = await asyncio.gather(*stages)
+        finally:
+            for stage in stages:
+                stage.cancel()
+        return results[-1]
+
+    async def _fetch_stage(self, polls: list, feeds_queue: asyncio.Queue) -> None:
+        async def fetch(poll: FeedPoll) -> None:
+            hot = self.hedge_after is not None and poll.poll_interval <= 2 * self.poll_scheduler.min_interval
             try:
-                pubdate = time.strptime(item.xpath("pubDate")[0].text, "%a, %d %b %Y %H:%M:%S %z")
-                item_epoch = int(time.mktime(pubdate))
-                pubdate = time.strftime('%a, %d %b %Y %H:%M:%S %z', pubdate)
-            except ValueError:
+                poll.resp = await asyncio.wait_for(
+                    self.fetch_feed(poll.catid, poll.feed, poll.etag, poll.last_modified, hot), self.feed_timeout)
+                if poll.resp.is_error:
+                    poll.error = f"HTTP {poll.resp.status_code}"
+            except (httpx.HTTPError, asyncio.TimeoutError) as e:
+                poll.error = repr(e)
+            await feeds_queue.put(poll)
+        await asyncio.gather(*(fetch(poll) for poll in polls))
+        await feeds_queue.put(None)
+
+    async def _parse_stage(self, feeds_queue: asyncio.Queue, items_queue: asyncio.Queue,
+                           news_queue: asyncio.Queue) -> None:
+        """ Queue the items newer than the feed epoch for scraping, feeds list the most recent item first
+            so parsing stops at the first item not newer than the epoch. The feed is marked as parsed
+            on news_queue once all its items are queued """
+        while (poll := await feeds_queue.get()) is not None:
+            if poll.error is None and poll.resp.status_code != httpx.codes.NOT_MODIFIED:
                 try:
-                    pubdate = time.strptime(item.xpath("pubDate")[0].text, "%d %b %Y %H:%M:%S %z")
-                    struct_time = time.struct_time(pubdate)
-                    item_epoch = int(time.mktime(struct_time))
-                    if item_epoch != time.mktime(pubdate):
-                        print(f"EPOCHS ARE DIFFERENT: catid={catid}, name={name}, db_epoch={db_epoch},  ")
-                    pubdate = time.strftime('%a, %d %b %Y %H:%M:%S %z', pubdate)
+                    await self._queue_items(poll, items_queue)
+                except (etree.Error, ValueError) as e:
+                    print(f'{e!r} while parsing the feed {poll.name}, skipping it this time')
+                    poll.error = repr(e)
+            await news_queue.put((poll, None, None))
+        await items_queue.put(None)
+
+    async def _queue_items(self, poll: FeedPoll, items_queue: asyncio.Queue) -> None:
+        with FEED_PARSE_SECONDS.time(category=poll.catid):
+            for title, link, pubdate in iter_rss_items(poll.resp.content):
+                if not link or not pubdate:
+                    logging.warning(f"Item without {'link' if not link else 'pubDate'} in the feed {poll.name}, "
+                                    f"skipping it: {title!r}")
+                    continue
+                try:
+                    item_epoch = pubdate_to_epoch(pubdate)
                 except ValueError:
                     print(f"Bad pubdate format in rss feed page, raising ValueError from\n"
-                          f'{item.xpath("title")[0].text}')
+                          f'{title}')
                     raise
-            link = item.xpath("link")[0].text
-            if item_epoch > db_epoch:
-                title_descr_img_link = await self.parse_link_metas(link)
-                if not title_descr_img_link:
-                    return
-                rss_new_items.append(title_descr_img_link)
-                epochs_pool = max(epochs_pool, item_epoch)
-        if len(rss_new_items) > 1:
-            self.bot_db.update_epoch(int(time.time()), catid)
-            new_feeds[catid] = rss_new_items
-
-    async def parse_link_metas(self, link):
-        resp = httpx.get(link, follow_redirects=True)
-        if resp.status_code == 301:
-            logging.warning(f"This link gave 301 response: {link}")
-            print(f"This link gave 301 response: {link}")
-            return None
+                if item_epoch <= poll.db_epoch:
+                    break
+                poll.pending += 1
+                poll.new_epochs.append(item_epoch)
+                await items_queue.put((poll, link, item_epoch))
+
+    async def _scrape_stage(self, items_queue: asyncio.Queue, news_queue: asyncio.Queue) -> None:
+        """ 'max_concurrency' workers scraping the queued articles (see 'fetch_article_head') """
+        async def worker() -> None:
+            while (item := await items_queue.get()) is not None:
+                poll, link, item_epoch = item
+                try:
+                    news = await self.parse_link_metas(link)
+                except Exception:  # an article the scraper can't cope with fails alone, not the whole round
+                    logging.exception(f"Unexpected error scraping {link}, skipping it")
+                    news = None
+                await news_queue.put((poll, item_epoch, news))
+            await items_queue.put(None)  # wake up the next worker
+        await asyncio.gather(*(worker() for _ in range(self.scrapers)))
+        await news_queue.put(None)
+
+    async def _publish_stage(self, news_queue: asyncio.Queue, publish, now: int) -> int:
+        """ Publish and archive whatever was scraped since the last batch and close the feeds
+            whose items are all handled, in one transaction per batch """
+        published = 0
+        while True:
+            batch = [await news_queue.get()]
+            while not news_queue.empty():
+                batch.append(news_queue.get_nowait())
+            scraped, completed = [], []
+            for entry in batch:
+                if entry is None:
+                    continue
+                poll, item_epoch, news = entry
+                if item_epoch is None:
+                    poll.parsed = True
+                else:
+                    poll.pending -= 1
+                    if news:
+                        scraped.append((item_epoch, poll, news))
+                    elif news is False or item_epoch < now - self.give_up_after:
+                        # never going to be scraped: handled, the feed epoch can move past it
+                        if news is not False:
+                            logging.warning(f"An article of {poll.name} published at {item_epoch} still can't "
+                                            f"be scraped after {self.give_up_after}s, skipping it")
+                    else:
+                        poll.failed.append(item_epoch)
+                if poll.parsed and not poll.pending:
+                    completed.append(poll)
+            new_feeds, polls = {}, {}
+            for _, poll, news in sorted(scraped, key=lambda x: x[0], reverse=True):
+                new_feeds.setdefault(poll.catid, [poll.name]).append(news)
+                polls[poll.catid] = poll
+            with self.bot_db.transaction():
+                if publish is not None and new_feeds:
+                    publish(new_feeds)
+                # the news scraped again (an older item of the feed failed last time) were already queued
+                # and archived: only the news new to the feed count for its polling interval
+                added = self.bot_db.archive_news([(news.news_hash, poll.catid, news.title.strip(),
+                                                   news.descr[:-6].strip(), news.link, item_epoch)
+                                                  for item_epoch, poll, news in scraped]) if scraped else {}
+                for catid, count in added.items():
+                    polls[catid].news_count += count
+                for poll in completed:
+                    self.close_poll(poll)
+                self.reschedule(now, completed)
+            published += sum(added.values())
+            if batch[-1] is None:
+                return published
+
+    def close_poll(self, poll) -> None:
+        """ Move the feed epoch up to the publication date every item has been handled until
+            (it stops before the oldest article that could not be scraped) and store its validators.
+            A feed that failed keeps its epoch and validators: the items after the error were never seen """
+        if poll.error is not None:
+            if poll.resp is not None and (poll.etag or poll.last_modified):
+                self.bot_db.update_validators(poll.catid, None, None)
+            return
+        if poll.failed:
+            epoch = max([item_epoch for item_epoch in poll.new_epochs if item_epoch < min(poll.failed)],
+                        default=poll.db_epoch)
+        else:
+            epoch = max(poll.new_epochs, default=poll.db_epoch)
+        if epoch != poll.db_epoch:
+            self.bot_db.update_epoch(epoch, poll.catid)
+        if poll.resp.status_code == httpx.codes.NOT_MODIFIED:
+            return
+        # with a failed article the feed must be downloaded again next time, not answered 304
+        new_validators = (poll.resp.headers.get("etag"), poll.resp.headers.get("last-modified")) \
+            if not poll.failed else (None, None)
+        if new_validators != (poll.etag, poll.last_modified):
+            self.bot_db.update_validators(poll.catid, *new_validators)
+
+    def reschedule(self, now: int, polls: list) -> None:
+        """ Store when every polled feed is due again, according to how many news it just had """
+        schedules = []
+        for poll in polls:
+            if poll.error is not None:
+                # the polling interval is kept for when the feed is back
+                retry = self.poll_scheduler.retry_interval(poll.failures + 1)
+                logging.warning(f"{poll.error} polling {poll.feed}, failure {poll.failures + 1}, retry in {retry}s")
+                schedules.append((poll.poll_interval, now, self.poll_scheduler.next_poll(now, retry),
+                                  poll.failures + 1, poll.error, poll.catid))
+                continue
+            elapsed = now - poll.last_polled if poll.last_polled else poll.poll_interval
+            interval = self.poll_scheduler.next_interval(poll.poll_interval, poll.news_count, elapsed)
+            schedules.append((interval, now, self.poll_scheduler.next_poll(now, interval), 0, None, poll.catid))
+        if schedules:
+            self.bot_db.update_poll_schedule(schedules)
+
+    def seconds_to_next_poll(self) -> int:
+        """ Seconds until the next feed is due, within the scheduler bounds; min_interval while there
+            is no feed yet (a new database waits for the first catalogue refresh) """
+        next_poll = self.bot_db.next_poll_at()
+        if next_poll is None:
+            return self.poll_scheduler.min_interval
+        return max(1, min(self.poll_scheduler.max_interval, next_poll - int(time.time())))
+
+    async def fetch_feed(self, catid: int, feed: str, etag: str, last_modified: str,
+                         hedge: bool = False) -> httpx.Response:
+        """ Conditional GET of a rss feed through the shared client,
+            hedge = send a second request if the first did not answer within 'hedge_after' seconds """
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            with FEED_FETCH_SECONDS.time(category=catid):
+                if hedge:
+                    req = await self._hedged_get(feed, headers)
+                else:
+                    req = await self.client.get(feed, headers=headers)
+        except httpx.HTTPError:
+            FEED_RESPONSES.inc(status="error")
+            raise
+        FEED_RESPONSES.inc(status=req.status_code)
+        FEED_BYTES.inc(len(req.content), category=catid)
+        return req
+
+    async def _hedged_get(self, url: str, headers: dict) -> httpx.Response:
+        """ GET url, again after 'hedge_after' seconds without an answer, return the first successful response """
+        tasks = {asyncio.ensure_future(self.client.get(url, headers=headers))}
         try:
-            html_root = html.parse(StringIO(resp.text))
-        except etree.XMLSyntaxError:
-            print(f"LINK THAT BROKE THE SCRIPT WITH XMLSyntaxError: {link}\n"
-                  f"resp is = {resp}\n"
-                  f"resp text = {resp.text}")
-            sys.exit(-1)
-        html_root = html.parse(StringIO(resp.text))
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                FEED_HEDGES.inc()
+                tasks.add(asyncio.ensure_future(self.client.get(url, headers=headers)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def aclose(self) -> None:
+        """ Close the pooled connections of the shared client """
+        await self.client.aclose()
+
+    async def fetch_article_head(self, link: str):
+        """ Stream an article page through the shared client and read it only up to '</head>',
+            at most 'max_concurrency' requests in flight overall and 'max_per_host' per host,
+            retrying transport errors, timeouts and 5xx; every attempt must end within 'fetch_timeout'.
+            Return '(status code, HEAD_METAS found)', None if unreachable for now,
+            False if it never will be (not a valid url, redirect loop...) """
         try:
-            title = html_root.xpath("//meta[@name='EdTitle']/@content")
-        except AssertionError:
-            print(f"link that broke the script with assertion error = {link}\n"
-                  f"resp is = {resp}\n"
-                  f"resp text is _ {resp.text}")
-            sys.exit(-1)
+            host = httpx.URL(link).host
+        except httpx.InvalidURL as e:
+            logging.warning(f"{e!r} for the article link {link!r}, skipping it")
+            return False
+        host_sem = self.host_sems.setdefault(host, asyncio.Semaphore(self.max_per_host))
+        attempt = 0
+        async with self.fetch_sem, host_sem:
+            while True:
+                try:
+                    with ARTICLE_FETCH_SECONDS.time():
+                        fetched = await asyncio.wait_for(self._get_article_head(link, attempt >= self.retries),
+                                                         self.fetch_timeout)
+                    if fetched is not None:
+                        return fetched
+                except (httpx.TransportError, asyncio.TimeoutError) as e:
+                    if attempt >= self.retries:
+                        logging.warning(f"{e!r} while fetching {link}, giving up after {attempt + 1} attempts")
+                        return None
+                except (httpx.HTTPError, httpx.InvalidURL, etree.Error) as e:
+                    # redirect loops, undecodable bodies, redirects to invalid urls: retrying won't help
+                    logging.warning(f"{e!r} while fetching {link}, giving up")
+                    return False
+                attempt += 1
+                await asyncio.sleep(0.5 * 2 ** attempt)
+
+    async def _get_article_head(self, link: str, last_attempt: bool):
+        """ A single attempt of 'fetch_article_head', None when a 5xx has to be retried """
+        async with self.client.stream("GET", link, follow_redirects=True, timeout=self.fetch_timeout) as resp:
+            if resp.status_code >= 500 and not last_attempt:
+                return None
+            if resp.is_error:
+                return resp.status_code, {}
+            return resp.status_code, await self._read_head_metas(resp)
+
+    @staticmethod
+    async def _read_head_metas(resp: httpx.Response) -> dict:
+        """ Feed the body to an incremental parser until the head is over,
+            the rest of the page is never downloaded (the connection is closed instead) """
+        parser = etree.HTMLPullParser(events=("start", "end"), encoding=resp.charset_encoding or "utf-8")
+        metas = {}
+        async for chunk in resp.aiter_bytes():
+            ARTICLE_BYTES.inc(len(chunk))
+            parser.feed(chunk)
+            if read_head_metas(parser, metas):
+                break
+        return metas
+
+    @timed(LINK_METAS_SECONDS)
+    async def parse_link_metas(self, link) -> NewsMessage:
+        """ Return the rendered NewsMessage of the article, scraping its page only once
+            even when the same article is carried by several feeds at the same time.
+            None when it can't be scraped now, False when it never will (see 'scrape_link_metas') """
+        try:
+            key = canonical_link(link)
+        except ValueError as e:  # urllib rejects the link (e.g. a broken IPv6 host)
+            logging.warning(f"{e!r} for the article link {link!r}, skipping it")
+            return False
+        news = self.meta_cache.get(key)
+        if news:
+            return news
+        pending = self.inflight.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self._load_link_metas(key, link))
+            self.inflight[key] = pending
+            pending.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _load_link_metas(self, key: str, link: str):
+        """ Look the article up in the database (if 'persist_metas') or scrape it, then render and cache it """
+        title_descr_img_link = None
+        if self.persist_metas:
+            title_descr_img_link = self.bot_db.get_article_meta(key, self.meta_ttl)
+        if not title_descr_img_link:
+            title_descr_img_link = await self.scrape_link_metas(link)
+            if not title_descr_img_link:
+                return title_descr_img_link
+            if self.persist_metas:
+                self.bot_db.put_article_meta(key, title_descr_img_link)
+        news = render_news(*title_descr_img_link)
+        self.meta_cache.put(key, news)
+        return news
+
+    async def scrape_link_metas(self, link):
+        """ Return '(title, descr, img, link)' of the article, None when it can't be read now
+            (unreachable, 5xx) and False when it never will (4xx, invalid link) """
+        fetched = await self.fetch_article_head(link)
+        if not fetched:
+            return fetched
+        status_code, metas = fetched
+        if status_code == 301 or status_code >= 400:
+            logging.warning(f"This link gave {status_code} response: {link}")
+            print(f"This link gave {status_code} response: {link}")
+            return None if status_code >= 500 else False
+        title = metas.get('EdTitle')
         if not title:
             title = ''
         else:
-            title = f'{title[0]}\n'
-        descr = html_root.xpath("//meta[@name='description']/@content")
-        if not descr:
+            title = f'{title}\n'
+        descr = metas.get('description')
+        if descr is None:
             descr = title
-        else:
-            descr = f'{descr[0]}'
-        img = self.fetch_correct_img(html_root)
+        img = self.fetch_correct_img(metas)
         return title, descr, img, link
 
     @staticmethod
-    def fetch_correct_img(html_root: etree._ElementTree) -> str:
+    def fetch_correct_img(metas: dict) -> str:
         """ Search for best img candidate to publish with the news post """
-        try:
-            img = html_root.xpath("//meta[@name='twitter:image:src']/@content")
-            if img and not img[0].endswith('.0'):
-                return img[0]
-            img = html_root.xpath("//meta[@property='og:image']/@content")
-            if img and not img[0].endswith('.0'):
-                return img[0]
-            return "https://www.ansa.it/sito/img/ico/ansa-700x366-precomposed.png"
-        except Exception as e:
-            print(f"{e} ERROR WHILE PARSING IMG IN RSSPARSER")
+        for key in ('twitter:image:src', 'og:image'):
+            img = metas.get(key)
+            if img and not img.endswith('.0'):
+                return img
+        return "https://www.ansa.it/sito/img/ico/ansa-700x366-precomposed.png"
@@ -0,0 +1,18 @@
+import sys
+import os
+
+import pytest
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """ Fresh database in a temporary directory (its 'db.log' included) """
+    monkeypatch.chdir(tmp_path)
+    database = Database(str(tmp_path / "bot.db"))
+    yield database
+    database.close()
@@ -0,0 +1,39 @@
+from articles import render_news, render_digest, link_label, CAPTION_LIMIT
+
+
+def test_short_caption_is_kept_whole():
+    news = render_news("Titolo\n", "Descrizione (ANSA)", "img", "https://www.ansa.it/a")
+    assert news.caption == "Titolo\nDescrizione \n[Read more](https://www.ansa.it/a)"
+
+
+def test_long_body_is_cut_with_an_ellipsis():
+    news = render_news("T " * 400 + "\n", "d" * 2000 + " (ANSA)", "img", "https://www.ansa.it/a")
+    assert len(news.caption) <= CAPTION_LIMIT
+    assert news.caption.endswith("…\n[Read more](https://www.ansa.it/a)")
+
+
+def test_escaped_body_is_cut_to_fit():
+    news = render_news("", "d_*" * 500 + " (ANSA)", "img", "https://www.ansa.it/a")
+    assert CAPTION_LIMIT - 3 <= len(news.caption) <= CAPTION_LIMIT
+
+
+def test_link_too_long_for_a_caption_is_left_to_the_text():
+    link = "https://www.ansa.it/" + "a" * 1100
+    news = render_news("Titolo\n", "Descrizione (ANSA)", "img", link)
+    assert len(news.caption) <= CAPTION_LIMIT
+    assert link not in news.caption
+    assert link in news.text
+
+
+def test_link_label_falls_back_to_the_description_then_the_link():
+    assert link_label("Titolo [1]\n", "", "l") == "Titolo \\[1)"
+    assert link_label("", "Solo descrizione", "l") == "Solo descrizione"
+    assert link_label("\n", " ", "https://a/1") == "https://a/1"
+    assert link_label("x" * 300, "", "l").endswith("…")
+
+
+def test_digest_never_renders_an_empty_link():
+    news = [render_news("", "", "img", f"https://www.ansa.it/{i}") for i in range(3)]
+    (text, included), = render_digest(news)
+    assert "[]" not in text
+    assert included == news
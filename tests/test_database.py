@@ -0,0 +1,38 @@
+def test_claim_outbox_shards_negative_chat_ids(db):
+    chats = [-1001000000003, -1001000000002, -1001000000001, -1001000000000, -5, 6, 7, 8]
+    db.enqueue_news([("h", "{}")], [])
+    for chat_id in chats:
+        db.channel_update_or_insert(chat_id, f"chat {chat_id}")
+    db.enqueue_news([("h", "{}")], [(chat_id, "h", 0) for chat_id in chats])
+    shards = 4
+    assert sum(db.outbox_depth(shard, shards) for shard in range(shards)) == len(chats)
+    claimed = {shard: [row[1] for row in db.claim_outbox("w", shard, shards, 100, 60)] for shard in range(shards)}
+    assert sorted(sum(claimed.values(), [])) == sorted(chats)
+    for shard, chat_ids in claimed.items():
+        assert all(chat_id % shards == shard for chat_id in chat_ids)
+
+
+def test_enqueue_news_skips_removed_chats(db):
+    db.channel_update_or_insert(1, "one")
+    db.enqueue_news([("h", "{}")], [(1, "h", 0), (2, "h", 0)])
+    assert [row[1] for row in db.claim_outbox("w", 0, 1, 10, 60)] == [1]
+
+
+def test_archive_counts_only_news_new_to_the_category(db):
+    row = ("h1", 1, "Governo a Roma", "descr", "https://a/1", 100)
+    assert db.archive_news([row, ("h2", 2, "t", "d", "https://a/2", 100)]) == {1: 1, 2: 1}
+    assert db.archive_news([row]) == {1: 0}
+    assert db.archive_news([("h1", 3, "Governo a Roma", "descr", "https://a/1", 100)]) == {3: 1}
+
+
+def test_search_archive_quotes_the_terms(db):
+    db.archive_news([("h1", 1, "Il governo di Roma", "AND OR NEAR", "https://a/1", 100),
+                     ("h2", 2, "Roma, città eterna", "", "https://a/2", 101)])
+    assert [row[2] for row in db.search_archive(["roma"])] == ["https://a/2", "https://a/1"]
+    assert [row[2] for row in db.search_archive(["CITTA"])] == ["https://a/2"]
+    assert [row[2] for row in db.search_archive(["roma"], category_id=1)] == ["https://a/1"]
+    assert [row[2] for row in db.search_archive(["governo di roma"])] == ["https://a/1"]
+    assert [row[2] for row in db.search_archive(['"', "*", "("])] == []
+    # operators are searched as words
+    assert [row[2] for row in db.search_archive(["NEAR(", "AND"])] == ["https://a/1"]
+    assert [row[2] for row in db.search_archive(['di', 'governo'])] == ["https://a/1"]
@@ -0,0 +1,74 @@
+import random
+import re
+
+from keywords import KeywordMatcher, normalize
+from database.filters import FilterIndex
+
+
+def test_normalize_ignores_case_and_accents():
+    assert normalize("Città PERCHÉ") == "citta perche"
+
+
+def test_find_whole_words_only():
+    matcher = KeywordMatcher(["roma", "calcio"])
+    assert matcher.find("La Roma vince") == {"roma"}
+    assert matcher.find("Romania e calciomercato") == set()
+    assert matcher.find("roma") == {"roma"}
+    assert matcher.find("(calcio)") == {"calcio"}
+
+
+def test_find_is_case_and_accent_insensitive():
+    assert KeywordMatcher(["citta"]).find("CITTÀ eterna") == {"citta"}
+    assert KeywordMatcher(["Città"]).find("la citta") == {"citta"}
+
+
+def test_find_overlapping_keywords_through_failure_links():
+    matcher = KeywordMatcher(["he", "she", "his", "hers", "she said"])
+    assert matcher.find("she said hers") == {"she", "she said", "hers"}
+    assert matcher.find("ushers") == set()
+
+
+def test_find_matches_a_whole_word_regex():
+    rng = random.Random(7)
+    words = ["ab", "abc", "bc", "c", "ca", "abca", "b c"]
+    matcher = KeywordMatcher(words)
+    for _ in range(500):
+        text = ''.join(rng.choice("abc .") for _ in range(rng.randint(0, 30)))
+        expected = {w for w in words if re.search(rf"(?<!\w){re.escape(w)}(?!\w)", text)}
+        assert matcher.find(text) == expected, text
+
+
+def test_empty_matcher_finds_nothing():
+    assert KeywordMatcher().find("anything") == set()
+    assert KeywordMatcher(["  "]).keywords == frozenset()
+
+
+def test_allowed_include_and_exclude():
+    index = FilterIndex([(1, "roma", 0), (2, "calcio", 1), (3, "roma", 0), (3, "lazio", 1)])
+    channels = [1, 2, 3, 4]
+    assert index.allowed(channels, "Roma, il calcio") == [1, 3, 4]
+    assert index.allowed(channels, "Roma e Lazio") == [1, 2, 4]
+    assert index.allowed(channels, "Milano") == [2, 4]
+
+
+def test_allowed_without_filters_returns_every_chat():
+    channels = [1, 2]
+    assert FilterIndex().allowed(channels, "text") is channels
+
+
+def test_find_then_allowed_by_equals_allowed():
+    index = FilterIndex([(1, "roma", 0), (2, "roma", 1)])
+    found = index.find("A Roma")
+    assert index.allowed_by([1, 2, 3], found) == index.allowed([1, 2, 3], "A Roma") == [1, 3]
+
+
+def test_remove_keywords_and_channel():
+    index = FilterIndex([(1, "roma", 0), (1, "lazio", 0), (2, "roma", 1)])
+    index.remove(1, ["lazio"])
+    assert index.filters(1) == {("roma", False)}
+    assert index.allowed([1, 2], "Lazio") == [2]
+    index.remove_channel(1)
+    assert index.filters(1) == frozenset()
+    assert index.allowed([1, 2], "Lazio") == [1, 2]
+    index.remove(2, ["roma"])
+    assert index.allowed([1, 2], "Roma") == [1, 2]
@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+from ratelimit import TokenBucket
+
+
+def test_bucket_spaces_tokens_at_its_rate():
+    async def take(bucket, n):
+        start = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - start
+    elapsed = asyncio.run(take(TokenBucket(20, 1), 5))
+    assert 0.18 <= elapsed < 0.5  # the first token is free, then one every 50 ms
+
+
+def test_bucket_burst_up_to_capacity():
+    async def take(bucket, n):
+        start = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - start
+    assert asyncio.run(take(TokenBucket(1, 5), 5)) < 0.05
+
+
+def test_block_refuses_tokens_for_a_while():
+    async def take():
+        bucket = TokenBucket(1000, 10)
+        bucket.block(0.1)
+        start = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - start
+    assert asyncio.run(take()) >= 0.09
+
+
+def test_restart_counts_the_next_token_from_now():
+    async def take():
+        bucket = TokenBucket(10, 1)
+        await bucket.acquire()
+        await asyncio.sleep(0.08)  # the next token would be almost ready...
+        bucket.restart()  # ...but the send only ended now
+        start = time.monotonic()
+        await bucket.acquire()
+        return time.monotonic() - start
+    assert asyncio.run(take()) >= 0.09
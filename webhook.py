@@ -0,0 +1,182 @@
+""" Webhook ingress: telegram POSTs the updates to a small asyncio HTTP server running on the same
+    event loop as the RSS publisher, the updates are handed to the python-telegram-bot dispatcher
+    in batches. 'python webhook.py replay updates.jsonl' sends recorded updates to a running server """
+from telegram.ext import Dispatcher
+from telegram import Update
+import telegram
+import argparse
+import asyncio
+import logging
+import httpx
+import json
+import time
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+MAX_BODY = 1024 * 1024  # telegram updates are a few KB
+
+
+class WebhookServer:
+    """ Minimal HTTP/1.1 server (keep-alive, Content-Length bodies) accepting the updates POSTed
+        to 'url_path'. Telegram gets its answer as soon as the body is read, the updates are decoded
+        and put in the dispatcher queue by 'batch_size' at most every 'batch_delay' seconds,
+        dropping the ones telegram sent again (same update_id). The path and the secret token are checked
+        before the body is read, bodies over MAX_BODY are refused and every read must end within 'read_timeout' """
+    __slots__ = ["bot", "dispatcher", "url_path", "secret_token", "batch_size", "batch_delay", "record",
+                 "read_timeout", "pending", "wakeup", "seen", "server", "batcher"]
+
+    def __init__(self, bot: telegram.Bot, dispatcher: Dispatcher, url_path: str = "/telegram",
+                 secret_token: str = None, batch_size: int = 100, batch_delay: float = 0.01, record: str = None,
+                 read_timeout: float = 30.0):
+        """ secret_token = value telegram sends in the X-Telegram-Bot-Api-Secret-Token header (see 'set_webhook')
+            record = jsonl file every update received is appended to, to be replayed later
+            read_timeout = seconds a connection may take to send a request line, a header or a body,
+                idle keep-alive connections included """
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.url_path = url_path
+        self.secret_token = secret_token
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.record = record
+        self.read_timeout = read_timeout
+        self.pending = []  # update dicts not dispatched yet
+        self.wakeup = asyncio.Event()
+        self.seen = {}  # update_id: time received, to drop the updates telegram retries
+        self.server = None
+        self.batcher = None
+
+    async def start(self, listen: str = "127.0.0.1", port: int = 8443) -> None:
+        self.server = await asyncio.start_server(self._serve, listen, port)
+        self.batcher = asyncio.create_task(self._dispatch())
+        logging.info(f"Webhook listening on {listen}:{port}{self.url_path}")
+
+    async def close(self) -> None:
+        if self.batcher is not None:
+            self.batcher.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def set_webhook(self, webhook_url: str, max_connections: int = 40) -> bool:
+        """ Tell telegram where to send the updates (blocking Bot API call) """
+        return self.bot.set_webhook(url=webhook_url, max_connections=max_connections,
+                                    secret_token=self.secret_token, allowed_updates=Update.ALL_TYPES)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+                except asyncio.TimeoutError:
+                    break  # idle keep-alive connection
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                status = self._check(method, path.split("?")[0], headers)
+                if status is None:
+                    body = await asyncio.wait_for(reader.readexactly(int(headers.get("content-length", 0))),
+                                                  self.read_timeout)
+                    status = self._receive(body)
+                # the body of a refused request was not read, the connection can't be reused
+                close = not status.startswith("200") or headers.get("connection", "").lower() == "close"
+                connection = "Connection: close\r\n" if close else ""
+                writer.write(f"HTTP/1.1 {status}\r\n{connection}Content-Length: 0\r\n\r\n".encode())
+                await writer.drain()
+                if close:
+                    break
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError) as e:
+            logging.warning(f"{e!r} on a webhook connection, closing it")
+        finally:
+            writer.close()
+
+    def _check(self, method: str, path: str, headers: dict):
+        """ Return the HTTP status line refusing the request from its head, None if its body can be read """
+        if path != self.url_path:
+            return "404 Not Found"
+        if method != "POST":
+            return "405 Method Not Allowed"
+        if self.secret_token and headers.get(SECRET_HEADER) != self.secret_token:
+            return "403 Forbidden"
+        length = headers.get("content-length", "0")
+        if not length.isdigit():
+            return "411 Length Required"
+        if int(length) > MAX_BODY:
+            return "413 Payload Too Large"
+        return None
+
+    def _receive(self, body: bytes) -> str:
+        """ Queue the update of an accepted request, return the HTTP status line """
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return "400 Bad Request"
+        if self.record:
+            with open(self.record, "a", encoding="utf-8") as f:
+                f.write(json.dumps(data, ensure_ascii=False) + "\n")
+        self.pending.append(data)
+        self.wakeup.set()
+        return "200 OK"
+
+    async def _dispatch(self) -> None:
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.batch_delay)  # let a burst gather into one batch
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            if not self.pending:
+                self.wakeup.clear()
+            now = time.monotonic()
+            for data in batch:
+                update_id = data.get("update_id")
+                if update_id in self.seen:
+                    continue
+                self.seen[update_id] = now
+                try:
+                    self.dispatcher.update_queue.put(Update.de_json(data, self.bot))
+                except (KeyError, TypeError, ValueError) as e:
+                    logging.warning(f"{e!r} decoding the update {update_id}, dropped")
+            if len(self.seen) > 10 * self.batch_size:
+                # telegram retries an update for minutes at most
+                self.seen = {k: t for k, t in self.seen.items() if now - t < 3600}
+
+
+async def replay(path: str, url: str, secret_token: str = None, concurrency: int = 10) -> None:
+    """ POST every update recorded in the jsonl file to a webhook, 'concurrency' at a time """
+    headers = {SECRET_HEADER: secret_token} if secret_token else {}
+    with open(path, encoding="utf-8") as f:
+        updates = [line for line in f if line.strip()]
+    sem = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+
+    async def post(client: httpx.AsyncClient, update: str) -> int:
+        async with sem:
+            resp = await client.post(url, content=update.encode(), headers=headers)
+            return resp.status_code
+
+    async with httpx.AsyncClient() as client:
+        statuses = await asyncio.gather(*(post(client, update) for update in updates))
+    elapsed = time.perf_counter() - start
+    print(f"{len(updates)} updates replayed in {elapsed:.2f}s, "
+          f"{sum(status == 200 for status in statuses)} accepted")
+
+
+def main() -> None:
+    arg_parser = argparse.ArgumentParser(description="Replay recorded telegram updates to a webhook")
+    sub_parsers = arg_parser.add_subparsers(dest="command", required=True)
+    replay_parser = sub_parsers.add_parser("replay", help="POST the updates of a jsonl file to the webhook")
+    replay_parser.add_argument("path", help="jsonl file written by WebhookServer(record=...)")
+    replay_parser.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    replay_parser.add_argument("--secret-token", default=None)
+    replay_parser.add_argument("--concurrency", type=int, default=10)
+    args = arg_parser.parse_args()
+    asyncio.run(replay(args.path, args.url, args.secret_token, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()